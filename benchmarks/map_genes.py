@@ -0,0 +1,57 @@
+"""Benchmark of transcript to object mapping.
+
+Maps increasing numbers of random spots onto a synthetic label image and
+reports the time per spot, which should stay constant if mapping scales
+linearly in spot count.
+
+    python benchmarks/map_genes.py
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from scSpatial.mapping import map_spots
+
+IMAGE_SIZE = 10_000
+N_GENES = 500
+SPOT_COUNTS = [1_000_000, 2_000_000, 4_000_000, 8_000_000, 16_000_000]
+
+
+def make_objects(size: int, cell_size: int = 20) -> np.ndarray:
+    """label image with a grid of square objects, every other one is background"""
+    n = size // cell_size
+    labels = np.arange(1, n * n + 1, dtype=np.int32).reshape(n, n)
+    labels[::2, ::2] = 0
+    return np.kron(labels, np.ones((cell_size, cell_size), dtype=np.int32))
+
+
+def make_spots(n: int, size: int, rng: np.random.Generator) -> pd.DataFrame:
+    """random spots with columns x, y and gene"""
+    genes = pd.Categorical.from_codes(
+        rng.integers(0, N_GENES, n), categories=[f"gene_{i}" for i in range(N_GENES)]
+    )
+    return pd.DataFrame({
+        "x": rng.uniform(0, size, n).astype(np.float32),
+        "y": rng.uniform(0, size, n).astype(np.float32),
+        "gene": genes,
+    })
+
+
+def run():
+    rng = np.random.default_rng(0)
+    objects = make_objects(IMAGE_SIZE)
+
+    print(f"{'spots':>12} {'seconds':>10} {'ns/spot':>10}")
+    for n in SPOT_COUNTS:
+        spots = make_spots(n, IMAGE_SIZE, rng)
+
+        start = time.perf_counter()
+        map_spots(objects, spots)
+        elapsed = time.perf_counter() - start
+
+        print(f"{n:>12} {elapsed:>10.2f} {elapsed / n * 1e9:>10.1f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -1,13 +1,21 @@
+import importlib
 
 import scSpatial.dataset
 import scSpatial.segmentation
-import scSpatial.viewer
-import scSpatial.widgets
 import scSpatial.analysis
-import scSpatial.app
 
 VERSION = "0.1.4"
 
+# Modules importing napari and Qt widgets, imported on first use so the
+# pipeline can run without a display
+GUI_MODULES = ("viewer", "widgets", "app")
+
+
+def __getattr__(name):
+    if name in GUI_MODULES:
+        return importlib.import_module(f"scSpatial.{name}")
+    raise AttributeError(f"module 'scSpatial' has no attribute '{name}'")
+
 
 def run():
     "Entry point for CLI"
@@ -1,44 +1,217 @@
-from scanpy import AnnData
-import bone_fight as bf
+from anndata import AnnData
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import time
 import pandas as pd
 import numpy as np
+from scipy import sparse
 
+from contextlib import contextmanager
+from typing import Tuple
+
+#Import only for type hinting, bone_fight is imported when BoneFight runs
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import bone_fight
+
+from .jobs import report
+from .reference_cache import reference_cache, reference_key
 from .segmentation import Segmentation
+from .tiling import N_WORKERS
+
+REFERENCE_CHUNK_SIZE = 50_000 # reference cells read at once when aggregating
+EPOCHS = 200 # max epochs of the BoneFight fit
+LEARNING_RATE = 0.1 # learning rate of the BoneFight fit
+TRIAL_FRACTION = 0.25 # fraction of the epochs spent on the trial fit when stopping early
+TOLERANCE = 1e-3 # relative loss change per epoch regarded as converged
+BATCH_SEED = 0 # seed of the random assignment of cells to batches
+SCORE_BLOCK_SIZE = 10_000 # cells scored at once by ScoreTransfer
+NNLS_ITERATIONS = 200 # projected gradient steps of nnls_scores
+
+
+def group_means(X, groups: pd.Series, chunk_size: int = REFERENCE_CHUNK_SIZE) -> Tuple[pd.DataFrame, pd.Series]:
+    """Mean expression of each group of cells.
+
+    X: cells x genes, dense, sparse or a backed AnnData matrix
+    groups: group of each cell, cells without a group are left out
+
+    Sums are computed as a sparse group x cells indicator matrix times X,
+    one chunk of cells at a time, so only chunk_size cells are in memory
+    and sparse X is never densified. returns a groups x genes DataFrame
+    and the number of cells of each group"""
+    groups = groups.astype("category").cat.remove_unused_categories()
+    codes = groups.cat.codes.to_numpy()
+    n_groups = len(groups.cat.categories)
+    n_cells, n_genes = X.shape
+
+    sums = np.zeros((n_groups, n_genes))
+    for start in range(0, n_cells, chunk_size):
+        stop = min(start + chunk_size, n_cells)
+
+        # Indicator of the chunk, cells with a missing group have code -1 and no entry
+        chunk_codes = codes[start:stop]
+        cells = np.flatnonzero(chunk_codes >= 0)
+        indicator = sparse.csr_matrix(
+            (np.ones(len(cells)), (chunk_codes[cells], cells)), shape=(n_groups, stop - start)
+        )
+        chunk_sums = indicator @ X[start:stop]
+        sums += chunk_sums.toarray() if sparse.issparse(chunk_sums) else np.asarray(chunk_sums)
+        report("aggregating reference", stop, n_cells)
+
+    sizes = np.bincount(codes[codes >= 0], minlength=n_groups)
+    means = pd.DataFrame(sums / sizes[:, None], index=groups.cat.categories)
+    return means, pd.Series(sizes, index=groups.cat.categories)
+
+
+def read_reference(path: str) -> AnnData:
+    """Opens a reference dataset. .h5ad files are opened backed and read only,
+    so only obs and var are loaded and X is read in chunks when aggregating"""
+    if str(path).endswith(".h5ad"):
+        import anndata
+
+        return anndata.read_h5ad(path, backed="r")
+
+    import scanpy as sc
+
+    return sc.read(path)
+
+
+def correlation_scores(counts: sparse.csr_matrix, reference: np.ndarray) -> np.ndarray:
+    """Pearson correlation of the log counts of each cell with the log
+    mean expression of each group, over the genes.
+
+    counts: cells x genes, kept sparse
+    reference: groups x genes
+    returns cells x groups"""
+    counts = counts.astype(np.float32).log1p()
+    reference = np.log1p(reference.astype(np.float32))
+    n_genes = counts.shape[1]
+
+    # Centering the reference makes counts @ reference.T the covariance
+    centered = reference - reference.mean(axis=1, keepdims=True)
+    covariance = np.asarray(counts @ centered.T)
 
+    mean = np.asarray(counts.sum(axis=1)).ravel() / n_genes
+    squares = np.asarray(counts.multiply(counts).sum(axis=1)).ravel()
+    cell_norm = np.sqrt(np.maximum(squares - n_genes * mean**2, 0))
+    reference_norm = np.linalg.norm(centered, axis=1)
 
-class Bonefight:
-    def __init__(self, segmentation: Segmentation, reference: AnnData, groupby:str):
+    denominator = np.outer(cell_norm, reference_norm)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.where(denominator > 0, covariance / denominator, 0)
+    return scores.astype(np.float32)
+
+
+def nnls_scores(counts: sparse.csr_matrix, reference: np.ndarray, n_iter: int = NNLS_ITERATIONS) -> np.ndarray:
+    """Non negative weights of the groups best explaining the counts of each
+    cell, normalized to proportions.
+
+    Solves min ||counts - weights @ reference|| with weights >= 0 for all
+    cells at once by projected gradient descent.
+    counts: cells x genes, kept sparse
+    reference: groups x genes
+    returns cells x groups"""
+    reference = reference.astype(np.float32)
+    gram = reference @ reference.T
+    projected = np.asarray(counts.astype(np.float32) @ reference.T)
+
+    # Step of 1 / largest eigenvalue of the gram matrix guarantees descent
+    step = 1 / max(np.linalg.eigvalsh(gram)[-1], np.finfo(np.float32).tiny)
+    weights = np.zeros_like(projected)
+    for _ in range(n_iter):
+        weights = np.maximum(weights - step * (weights @ gram - projected), 0)
+
+    total = weights.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, weights / total, 0).astype(np.float32)
+
+
+SCORE_METHODS = dict(correlation=correlation_scores, nnls=nnls_scores)
+
+
+class LabelTransfer:
+    """Base class of label transfer methods.
+
+    Aggregates the reference into group means, finds the genes shared with
+    the segmentation and predicts a cells x groups cell_types table.
+    Subclasses implement predict."""
+    name: str = None
+
+    def __init__(self, segmentation: Segmentation, reference: AnnData, groupby: str, reference_path: str = None):
         """perform label transfer from reference to the segmentation.
-        
+
         groupby: key in AnnData.obs containing cell type annotation
+        reference_path: file the reference was read from, used to cache the
+        aggregated reference. Defaults to the file of a backed reference
+
+        After a transfer, self.timings holds the seconds spent in each phase
         """
         self.segmentation = segmentation
         self.reference = reference
         self.groupby = groupby
+        self.reference_path = reference_path
+        if self.reference_path is None and reference.isbacked:
+            self.reference_path = str(reference.filename)
+        self.timings: dict = dict()
 
     def transfer_labels(self) -> pd.DataFrame:
         # group by key and calculate mean gene expression
-        self.reference_mean = self.groupby_mean()
+        report("aggregating reference")
+        with self.timer("aggregation"):
+            self.reference_mean, self.reference_sizes = self.aggregate_reference()
 
         # Find intersecting genes
         self.intersecting_genes = self.find_intersecting_genes()
 
         # Predict labels
-        return self.predict()
+        report("transferring labels")
+        cell_types = self.predict()
 
-    def groupby_mean(self) -> pd.DataFrame:
-        logging.info("finding mean gene expression per group")
+        logging.info(f"{self.name} timings (s): {self.timings}")
+        return cell_types
+
+    def predict(self) -> pd.DataFrame:
+        """returns the cells x groups cell_types table"""
+        raise NotImplementedError
 
-        data = self.reference.X.T
-        idx = self.reference.var_names
-        col = self.reference.obs_names
+    @contextmanager
+    def timer(self, phase: str):
+        """adds the seconds spent in the with block to self.timings[phase]"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0) + time.perf_counter() - start
 
-        df = pd.DataFrame(data, index=idx, columns=col)
+    def aggregate_reference(self) -> Tuple[pd.DataFrame, pd.Series]:
+        """returns group means and sizes of the reference, from reference_cache
+        when the same reference file was aggregated by groupby before"""
+        if self.reference_path is None:
+            return self.groupby_mean()
 
-        result = df.groupby(by=self.reference.obs[self.groupby], axis=1).mean()
+        key = reference_key(self.reference_path, self.groupby)
+        cached = reference_cache.get(key)
+        if cached is not None:
+            return cached
 
-        return result
+        means, sizes = self.groupby_mean()
+        reference_cache.put(key, means, sizes)
+        return means, sizes
+
+    def groupby_mean(self) -> Tuple[pd.DataFrame, pd.Series]:
+        """returns the mean expression of each group as a genes x groups DataFrame,
+        and the number of cells in each group.
+        Works on sparse and backed references without densifying them"""
+        logging.info("finding mean gene expression per group")
+
+        means, sizes = group_means(self.reference.X, self.reference.obs[self.groupby])
+
+        result = means.T
+        result.index = self.reference.var_names
+        result.columns.name = self.groupby
+        sizes.index = result.columns
+
+        return result, sizes
 
     def find_intersecting_genes(self) -> set:
         logging.info("Finding intersecting genes")
@@ -50,29 +223,172 @@ class Bonefight:
 
         return intersect_genes
 
+
+class ScoreTransfer(LabelTransfer):
+    """Vectorized label transfer scoring each cell against the group means.
+
+    method: "correlation" or "nnls", see correlation_scores and nnls_scores
+    Cells are scored in blocks of block_size from the sparse gene
+    expression, on n_workers threads."""
+
+    def __init__(
+        self,
+        segmentation: Segmentation,
+        reference: AnnData,
+        groupby: str,
+        reference_path: str = None,
+        method: str = "correlation",
+        block_size: int = SCORE_BLOCK_SIZE,
+        n_workers: int = N_WORKERS
+    ):
+        super().__init__(segmentation, reference, groupby, reference_path)
+        self.method = method
+        self.name = f"{method} transfer"
+        self.block_size = block_size
+        self.n_workers = n_workers
+
+    def predict(self) -> pd.DataFrame:
+        score = SCORE_METHODS[self.method]
+
+        with self.timer("views"):
+            genes = sorted(self.intersecting_genes)
+            reference = self.reference_mean.loc[genes]
+            target = self.segmentation.gene_expression.filter(genes).matrix
+            reference_tensor = reference.to_numpy(dtype=np.float32).T
+
+        with self.timer("transform"):
+            y = np.empty((target.shape[0], reference_tensor.shape[0]), dtype=np.float32)
+            starts = range(0, target.shape[0], self.block_size)
+
+            def score_block(start):
+                stop = start + self.block_size
+                y[start:stop] = score(target[start:stop], reference_tensor)
+
+            with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+                for i, _ in enumerate(pool.map(score_block, starts)):
+                    report("transferring labels", i + 1, len(starts))
+
+        return pd.DataFrame(y, columns=reference.columns, index=self.segmentation.gene_expression.index)
+
+
+class Bonefight(LabelTransfer):
+    name = "BoneFight"
+
+    def __init__(
+        self,
+        segmentation: Segmentation,
+        reference: AnnData,
+        groupby:str,
+        reference_path: str = None,
+        epochs: int = EPOCHS,
+        learning_rate: float = LEARNING_RATE,
+        early_stopping: bool = False,
+        tolerance: float = TOLERANCE,
+        batch_size: int = None
+    ):
+        """perform label transfer from reference to the segmentation with BoneFight.
+        
+        epochs, learning_rate: settings of the BoneFight fit
+        early_stopping: stop before epochs when the loss changes less than
+        tolerance (relative, per epoch), see fit
+        batch_size: transfer labels to at most batch_size cells at a time,
+        None transfers to all cells at once
+
+        After a transfer, self.losses holds the loss of each epoch of the last fit
+        """
+        super().__init__(segmentation, reference, groupby, reference_path)
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.early_stopping = early_stopping
+        self.tolerance = tolerance
+        self.batch_size = batch_size
+        self.losses: list = list()
+
     def create_reference_view(self):
-        self.reference_volume = self.reference.obs[self.groupby].value_counts(sort=False)[self.reference_mean.columns]
-        self.reference_volume = self.reference_volume.to_numpy()
+        import bone_fight as bf
+
+        self.reference_volume = self.reference_sizes[self.reference_mean.columns].to_numpy(dtype=np.float32)
         self.reference_filtered = self.reference_mean.filter(self.intersecting_genes, axis=0)
-        self.reference_tensor = self.reference_filtered.to_numpy().T
+        self.reference_tensor = self.reference_filtered.to_numpy(dtype=np.float32).T
         self.a = bf.View(self.reference_tensor, self.reference_volume)
         
 
-    def create_target_view(self):
-        
-        self.target_tensor = self.segmentation.gene_expression.filter(self.intersecting_genes, axis=1)
-        self.target_tensor = self.target_tensor.to_numpy()
-        self.b = bf.View(self.target_tensor, np.ones(self.target_tensor.shape[0]))
+    def create_target_view(self, matrix: sparse.csr_matrix):
+        """create the target view from sparse counts of intersecting genes,
+        only the cells of matrix are densified"""
+        import bone_fight as bf
+
+        self.target_tensor = matrix.astype(np.float32).toarray()
+        self.b = bf.View(self.target_tensor, np.ones(self.target_tensor.shape[0], dtype=np.float32))
        
 
+    def fit(self) -> "bone_fight.BoneFight":
+        """Fit BoneFight for self.epochs, or until converged with early stopping.
+
+        bone_fight has no per epoch callback and every fit starts from
+        scratch, so early stopping runs a trial fit of TRIAL_FRACTION of the
+        epochs and keeps it if its loss has converged. Otherwise the model
+        is fit again for the full self.epochs, so the result is the same as
+        without early stopping, at worst 1 + TRIAL_FRACTION times slower"""
+        import bone_fight as bf
+
+        if not self.early_stopping:
+            model = bf.BoneFight(self.a, self.b).fit(self.epochs, self.learning_rate)
+            self.losses = list(map(float, getattr(model, "losses", [])))
+            return model
+
+        trial = max(1, int(self.epochs * TRIAL_FRACTION))
+        model = bf.BoneFight(self.a, self.b).fit(trial, self.learning_rate)
+        self.losses = list(map(float, getattr(model, "losses", [])))
+        if trial >= self.epochs or self.converged():
+            return model
+
+        report("transferring labels")
+        model = bf.BoneFight(self.a, self.b).fit(self.epochs, self.learning_rate)
+        self.losses = list(map(float, getattr(model, "losses", [])))
+        return model
+
+    def converged(self) -> bool:
+        """returns True if the loss changed less than tolerance per epoch
+        over the last tenth of the fit"""
+        window = max(2, len(self.losses) // 10)
+        if len(self.losses) < window:
+            return False
+
+        start, end = self.losses[-window], self.losses[-1]
+        change = abs(start - end) / max(abs(start), np.finfo(np.float32).tiny)
+        return change / (window - 1) < self.tolerance
+
+    def batches(self, n_cells: int) -> list:
+        """returns sorted row positions of each batch of cells.
+        Cells are assigned at random so every batch samples the whole tissue"""
+        if self.batch_size is None or n_cells <= self.batch_size:
+            return [np.arange(n_cells)]
+
+        order = np.random.default_rng(BATCH_SEED).permutation(n_cells)
+        return [np.sort(order[start:start + self.batch_size]) for start in range(0, n_cells, self.batch_size)]
+
     def predict(self) -> pd.DataFrame:
-        # TODO: add parameters for this
-        self.create_reference_view()
-        self.create_target_view()
+        """Fit the reference aggregate to the cells, one batch of cells at a time.
+        Predictions are written into one float32 cells x groups array"""
+        with self.timer("views"):
+            self.create_reference_view()
+            self.labels = np.eye(self.reference_tensor.shape[0], dtype=np.float32)
+
+        target = self.segmentation.gene_expression.filter(self.intersecting_genes).matrix
+        y = np.empty((target.shape[0], self.labels.shape[0]), dtype=np.float32)
+
+        batches = self.batches(target.shape[0])
+        for i, rows in enumerate(batches):
+            report("transferring labels", i, len(batches))
+            with self.timer("views"):
+                self.create_target_view(target[rows])
+
+            with self.timer("fit"):
+                self.model = self.fit()
 
-        self.model = bf.BoneFight(self.a, self.b).fit(200, 0.1)
-        self.labels = np.eye(self.reference_tensor.shape[0])
-        y = self.model.transform(self.labels)
+            with self.timer("transform"):
+                y[rows] = self.model.transform(self.labels)
 
         cell_types = pd.DataFrame(y, columns=self.reference_filtered.columns, index = self.segmentation.gene_expression.index)
         return cell_types
@@ -1,6 +1,7 @@
 import napari
 
 from .dataset import Dataset
+from .model_registry import warm_up
 from .widgets.main_widget import mainWidget
 from .viewer import Viewer
 
@@ -14,6 +15,9 @@ class App:
 
     def __init__(self):
 
+        # Load Cellpose models in the background while the GUI starts
+        warm_up()
+
         # Instatiate the empty dataset and viewer objects
         self.dataset = Dataset("scSpatial experiment")
         self.viewer = Viewer(
@@ -1,11 +1,15 @@
 from cellpose import models
 from PyQt5.QtCore import QObject, pyqtSignal
-from imageio import v3 as imageio
+import os
 import pandas as pd
 import numpy as np
 
 from typing import Tuple
 
+from .images import image_pyramid, open_image
+from .result_cache import hash_image
+from .spatial_index import SpatialIndex
+from .transcripts import TranscriptFile
 from .utility import select_file
 
 from typing import TYPE_CHECKING
@@ -35,9 +39,15 @@ class Dataset:
         # Assign information about dataset
         self.name: str = name
 
-        # Create datastructures
+        # Create datastructures, images are lazy array-like objects (see open_image)
         self.images: dict[str, np.ndarray] = dict()
+        self.image_paths: dict[str, str] = dict()
+        self.image_sources: dict[str, tuple] = dict() # file of each image and its offset in the file, kept by crops
+        self.pyramids: dict[str, list] = dict()
+        self.image_digests: dict[str, tuple] = dict() # image and its pixel digest by channel
         self.gene_expression: pd.DataFrame = None
+        self.spatial_index: SpatialIndex = None
+        self.transcript_file: TranscriptFile = None # used instead of gene_expression for large files
 
         # Note, these are now added from the segmentation class
         self.segmentation: dict[int, "Segmentation"] = dict()
@@ -57,30 +67,82 @@ class Dataset:
         if not path:
             path = select_file(title="Please select a nuclei image")
 
-        image = imageio.imread(path)
+        image = open_image(path)
         self.images["Nuclei"] = image
+        self.image_paths["Nuclei"] = path
+        self.image_sources["Nuclei"] = (path, (0, 0))
+        self.pyramids.pop("Nuclei", None)
 
     def load_cytoplasm(self, path=False):
         """load cytoplasm image and store under images["Cytoplasm"]"""
         if not path:
             path = select_file(title="Please select a cytoplasm image")
 
-        image = imageio.imread(path)
+        image = open_image(path)
         self.images["Cytoplasm"] = image
+        self.image_paths["Cytoplasm"] = path
+        self.image_sources["Cytoplasm"] = (path, (0, 0))
+        self.pyramids.pop("Cytoplasm", None)
 
     def load_other_channel(self, channel="other", path=False):
         """load channel image and store under images[channel]"""
         if not path:
             path = select_file(title=f"Please select a {channel} image")
 
-        image = imageio.imread(path)
+        image = open_image(path)
         self.images[channel] = image
+        self.image_paths[channel] = path
+        self.image_sources[channel] = (path, (0, 0))
+        self.pyramids.pop(channel, None)
+
+    def get_pyramid(self, channel: str) -> list:
+        """returns the multiscale pyramid of images[channel],
+        built on first use and cached next to the image file, or in the
+        user cache directory if its folder is read-only.
+        Images stored in a project without a file have a single level"""
+        if channel not in self.image_paths:
+            return [self.images[channel]]
+        if channel not in self.pyramids:
+            self.pyramids[channel] = image_pyramid(
+                self.images[channel], self.image_paths[channel]
+            )
+        return self.pyramids[channel]
+
+    def image_key(self, channel: str) -> tuple:
+        """returns a key identifying images[channel] and the crop of it.
+        Images without a file are identified by the digest of their pixels"""
+        image = self.images[channel]
+        source = self.image_sources.get(channel)
+        if source is None:
+            return (self.image_digest(channel), image.shape)
+        path, offset = source
+        return (path, os.path.getmtime(path), offset, image.shape)
+
+    def image_digest(self, channel: str) -> str:
+        """returns a digest of the pixels of images[channel], computed once per image"""
+        image = self.images[channel]
+        # The image is kept with its digest, so a replaced image is hashed again
+        cached = self.image_digests.get(channel)
+        if cached is None or cached[0] is not image:
+            cached = (image, hash_image(image))
+            self.image_digests[channel] = cached
+        return cached[1]
 
     def add_gene_expression(self, df):
-        """Loads gene expression"""
+        """Loads gene expression, spot positions are indexed on first crop"""
         self.gene_expression = df
+        self.transcript_file = None
+        self.spatial_index = None
         self.com.gene_expression_changed.emit()
         #TODO: Connect this signal to downstream functions
+
+    def add_transcript_file(self, transcript_file: TranscriptFile):
+        """Use a transcript file larger than memory for gene mapping.
+        Spots are streamed from the file in chunks when segmentations map genes"""
+        self.gene_expression = None
+        self.spatial_index = None
+        self.transcript_file = transcript_file
+        self.com.gene_expression_changed.emit()
         
 
     def add_segmentation(self, seg: "Segmentation"):
@@ -97,14 +159,17 @@ class Dataset:
         self, center: Tuple[float, float], width: int = 1000, height: int = 1000
     ) -> "Dataset":
         """returns a cropped version of the dataset
-        with added information about the cropping"""
+        with added information about the cropping.
+
+        center is given as (axis 0, axis 1) of the images. Cropped images
+        are views of the original images, not copies."""
 
         # Create the new dataset to cold the cropped data
         dataset = Dataset(name=f"cropped {self.name}")
 
         # Calculate the bounding box coordinates of the crop
-        x0, x1 = (int(center[0] - (width / 2)), int(center[0] + (width / 2)))
-        y0, y1 = (int(center[1] - (height / 2)), int(center[1] + (height / 2)))
+        x0, x1 = (max(int(center[0] - (width / 2)), 0), int(center[0] + (width / 2)))
+        y0, y1 = (max(int(center[1] - (height / 2)), 0), int(center[1] + (height / 2)))
 
         # Store cropping information
         dataset.center = center
@@ -113,23 +178,28 @@ class Dataset:
         dataset.boundingbox = (x0, x1, y0, y1)
         dataset.translate = (x0, y0)
 
-        # Cropping images
-        # TODO: investigate effect of modifying the iterable (image)
-        # Should these be moved to another variable fist?
+        # Cropping images, slicing returns views so no pixels are copied
         for name, image in self.images.items():
-            dataset.images[name] = image[x0:x1, y0:y1].copy()
+            dataset.images[name] = image[x0:x1, y0:y1]
+
+        # Crops have no image paths, so they get no pyramid cache,
+        # but keep the file and offset to identify their pixels
+        for name, (path, offset) in self.image_sources.items():
+            dataset.image_sources[name] = (path, (offset[0] + x0, offset[1] + y0))
 
-        # Cropping genes
+        # Cropping genes, spots are y along axis 0 and x along axis 1
         if isinstance(self.gene_expression, pd.DataFrame):
-            idx = list()
-            for i, gene in self.gene_expression.iterrows():
-                if gene.x > x0 and gene.x < x1:
-                    if gene.y > y0 and gene.y < y1:
-                        idx.append(i)
+            if self.spatial_index is None:
+                # Image axis 0 corresponds to y and axis 1 to x
+                self.spatial_index = SpatialIndex(
+                    row=self.gene_expression.y.to_numpy(),
+                    col=self.gene_expression.x.to_numpy()
+                )
+            idx = self.spatial_index.query(row0=x0, row1=x1, col0=y0, col1=y1)
 
             df = self.gene_expression.iloc[idx].copy()
-            df.x = df.x - x0
-            df.y = df.y - y0
+            df.x = df.x - y0
+            df.y = df.y - x0
             
             dataset.add_gene_expression(df)
 
@@ -0,0 +1,107 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from .jobs import report
+from .mapping import BATCH_SIZE, lookup_objects, write_object_ids
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from anndata import AnnData
+    from .segmentation import Segmentation
+
+
+def export_segmentation(seg: "Segmentation", path: str):
+    """Exports a segmentation to <path>.h5ad and the object of every
+    spot to <path>.spots.parquet"""
+    stem = os.path.splitext(str(path))[0]
+
+    report("exporting objects")
+    to_anndata(seg).write_h5ad(f"{stem}.h5ad")
+
+    if seg.dataset.gene_expression is not None or seg.dataset.transcript_file is not None:
+        report("exporting spots")
+        export_spots(seg, f"{stem}.spots.parquet")
+
+
+def to_anndata(seg: "Segmentation") -> "AnnData":
+    """Returns an AnnData of objects x genes with the sparse counts in X.
+
+    obs holds the object features and obsm the cell types and the centroid
+    of each object, as (x, y) under "spatial". var holds the spots of each
+    gene mapped to background and the percent mapped to objects."""
+    from anndata import AnnData
+    from scipy import sparse
+
+    features = seg.object_features.set_index("label")
+    features.index.name = "object_id"
+
+    # Objects without spots have no row in gene_expression, they get zero counts
+    if seg.gene_expression is not None:
+        genes = seg.gene_expression.columns
+        rows = pd.Series(np.arange(len(seg.gene_expression.index)), index=seg.gene_expression.index)
+        positions = rows.reindex(features.index).to_numpy()
+        mapped = ~np.isnan(positions)
+
+        matrix = seg.gene_expression.matrix
+        selection = sparse.csr_matrix(
+            (np.ones(mapped.sum(), dtype=matrix.dtype), (np.flatnonzero(mapped), positions[mapped].astype(np.intp))),
+            shape=(len(features), matrix.shape[0])
+        )
+        counts = selection @ matrix
+        var = pd.DataFrame({
+            "background": seg.background.reindex(genes).to_numpy(),
+            "pct_mapped_genes": seg.pct_mapped_genes.reindex(genes).to_numpy(),
+        }, index=genes.astype(str))
+    else:
+        counts = sparse.csr_matrix((len(features), 0), dtype=np.int32)
+        var = pd.DataFrame(index=pd.Index([], dtype=str))
+
+    obs = features.copy()
+    obs.index = obs.index.astype(str)
+
+    adata = AnnData(X=counts, obs=obs, var=var)
+    # Image axis 0 is y and axis 1 is x
+    adata.obsm["spatial"] = features[["centroid-1", "centroid-0"]].to_numpy()
+
+    if seg.cell_types is not None:
+        cell_types = seg.cell_types.reindex(features.index).astype(np.float32)
+        cell_types.index = obs.index
+        cell_types.columns = cell_types.columns.astype(str)
+        adata.obsm["cell_types"] = cell_types
+
+    adata.uns["segmentation"] = dict(
+        id=seg.id,
+        type=seg.type,
+        settings={key: str(value) for key, value in seg.settings.items()},
+        object_coverage=float(seg.object_coverage),
+    )
+    return adata
+
+
+def export_spots(seg: "Segmentation", path: str, batch_size: int = BATCH_SIZE):
+    """Writes x, y, gene and object id of every spot to a Parquet file,
+    batch_size spots at a time so memory stays bounded"""
+    if seg.object_mapping_path is not None and os.path.exists(seg.object_mapping_path):
+        # Streamed mappings are already written as Parquet
+        shutil.copyfile(seg.object_mapping_path, path)
+        return
+
+    if isinstance(seg.dataset.gene_expression, pd.DataFrame):
+        spots = seg.dataset.gene_expression
+        chunks = (spots.iloc[start:start + batch_size] for start in range(0, len(spots), batch_size))
+    else:
+        chunks = seg.dataset.transcript_file.chunks()
+
+    # Objects of a saved project are read from disk once
+    objects = np.asarray(seg.objects)
+
+    writer = None
+    for chunk in chunks:
+        # Looked up again as dataset.gene_expression.object_id belongs to the last mapped segmentation
+        object_ids = lookup_objects(objects, chunk.x.to_numpy(), chunk.y.to_numpy())
+        writer = write_object_ids(writer, path, chunk, object_ids)
+
+    if writer is not None:
+        writer.close()
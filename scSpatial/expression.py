@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from typing import Iterable, List
+
+
+class GeneExpression:
+    """Sparse object x gene count matrix.
+
+    Counts are stored as a CSR matrix so memory scales with the number of
+    detected counts instead of objects x genes.
+
+    matrix: object x gene counts
+    index: object id of each row
+    columns: gene name of each column
+    """
+
+    def __init__(self, matrix: sparse.spmatrix, index: Iterable, columns: Iterable):
+        self.matrix: sparse.csr_matrix = sparse.csr_matrix(matrix)
+        self.index = pd.Index(index, name="object_id")
+        self.columns = pd.Index(columns, name="gene")
+
+        # Positions used to look up rows and columns by label
+        self._rows = pd.Series(np.arange(len(self.index)), index=self.index)
+        self._cols = pd.Series(np.arange(len(self.columns)), index=self.columns)
+
+    def __repr__(self):
+        return f"GeneExpression: {self.shape[0]} objects x {self.shape[1]} genes, {self.matrix.nnz} nonzero"
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def get_gene(self, gene: str) -> pd.Series:
+        """returns counts of gene for every object"""
+        column = self.matrix[:, self._cols[gene]].toarray().ravel()
+        return pd.Series(column, index=self.index, name=gene)
+
+    def get_object(self, object_id: int) -> pd.Series:
+        """returns counts of every gene for one object"""
+        row = self.matrix[self._rows[object_id]].toarray().ravel()
+        return pd.Series(row, index=self.columns, name=object_id)
+
+    def gene_totals(self) -> pd.Series:
+        """returns total counts per gene over all objects"""
+        return pd.Series(np.asarray(self.matrix.sum(axis=0)).ravel(), index=self.columns)
+
+    def nonzero_genes(self) -> List[str]:
+        """returns genes detected in at least one object"""
+        detected = np.asarray(self.matrix.getnnz(axis=0)) > 0
+        return list(self.columns[detected])
+
+    def filter(self, genes: Iterable[str]) -> "GeneExpression":
+        """returns a new GeneExpression with the given genes, in the given order.
+        Genes not present are ignored, as in pandas.DataFrame.filter"""
+        genes = [gene for gene in genes if gene in self._cols.index]
+        matrix = self.matrix[:, self._cols[genes].to_numpy()]
+        return GeneExpression(matrix, index=self.index, columns=genes)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """returns a dense DataFrame, only use for small selections"""
+        return pd.DataFrame(self.matrix.toarray(), index=self.index, columns=self.columns)
@@ -0,0 +1,161 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import numpy as np
+import pandas as pd
+
+from typing import Tuple
+
+from .tiling import N_WORKERS
+
+CHUNK_PIXELS = 4 * 1024**2 # pixels of the label image reduced per chunk
+
+
+def label_runs(labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """returns row, first and last column of each run of one non zero label
+    along the rows of a label image, in row order"""
+    inside = labels != 0
+    first = inside.copy()
+    first[:, 1:] &= labels[:, 1:] != labels[:, :-1]
+    last = inside
+    last[:, :-1] &= labels[:, :-1] != labels[:, 1:]
+    row, col0 = np.nonzero(first)
+    col1 = np.nonzero(last)[1]
+    return row, col0, col1
+
+
+def chunk_features(labels: np.ndarray, row0: int, n: int, images: dict = dict()) -> dict:
+    """Per object reductions over one chunk of rows of a label image.
+
+    Objects are reduced over their runs along rows instead of pixel by
+    pixel, so only run ends are held in memory.
+
+    labels: chunk of the label image starting at row row0
+    n: number of labels (max label + 1) in the whole image
+    images: chunk of each intensity channel, same rows as labels"""
+    row, col0, col1 = label_runs(labels)
+    ids = labels[row, col0].astype(np.intp)
+    length = col1 - col0 + 1
+    row = row + row0
+
+    # Sums are reduced with bincount, extremes with ufunc.at
+    min_row = np.full(n, np.iinfo(np.int64).max)
+    min_col = np.full(n, np.iinfo(np.int64).max)
+    max_row = np.full(n, -1)
+    max_col = np.full(n, -1)
+    np.minimum.at(min_row, ids, row)
+    np.minimum.at(min_col, ids, col0)
+    np.maximum.at(max_row, ids, row)
+    np.maximum.at(max_col, ids, col1)
+
+    reductions = dict(
+        area=np.bincount(ids, weights=length, minlength=n).astype(np.int64),
+        sum_row=np.bincount(ids, weights=length * row, minlength=n),
+        sum_col=np.bincount(ids, weights=length * (col0 + col1) / 2, minlength=n),
+        min_row=min_row,
+        min_col=min_col,
+        max_row=max_row,
+        max_col=max_col,
+    )
+
+    # Intensity of each channel under the object pixels, reduced per run in the
+    # source dtype. Bounds alternate run start and the pixel after the run
+    bounds = np.empty(2 * len(ids), dtype=np.intp)
+    bounds[0::2] = (row - row0) * labels.shape[1] + col0
+    bounds[1::2] = bounds[0::2] + length
+    if len(bounds) > 0 and bounds[-1] == labels.size:
+        bounds = bounds[:-1]
+    for channel, image in images.items():
+        pixels = image.reshape(-1)
+        run_sum = np.add.reduceat(pixels, bounds, dtype=np.float64)[0::2] if len(ids) > 0 else np.zeros(0)
+        run_max = np.maximum.reduceat(pixels, bounds)[0::2] if len(ids) > 0 else np.zeros(0)
+        max_intensity = np.full(n, -np.inf)
+        np.maximum.at(max_intensity, ids, run_max)
+        reductions[f"sum_intensity:{channel}"] = np.bincount(ids, weights=run_sum, minlength=n)
+        reductions[f"max_intensity:{channel}"] = max_intensity
+
+    return reductions
+
+
+def combine(a: dict, b: dict) -> dict:
+    """combines reductions of two chunks, min_ and max_ keys by their
+    extreme and all other keys by their sum"""
+    combined = dict()
+    for key in a:
+        if key.startswith("min_"):
+            combined[key] = np.minimum(a[key], b[key])
+        elif key.startswith("max_"):
+            combined[key] = np.maximum(a[key], b[key])
+        else:
+            combined[key] = a[key] + b[key]
+    return combined
+
+
+def object_features(
+    labels: np.ndarray,
+    images: dict = dict(),
+    chunk_pixels: int = CHUNK_PIXELS,
+    n_workers: int = N_WORKERS
+) -> Tuple[pd.DataFrame, float]:
+    """Computes object features and object coverage in one pass over the label image.
+
+    The image is reduced in chunks of rows, in parallel threads. Chunks hold
+    about chunk_pixels pixels, so memory does not grow with the width of the
+    image. Returns a table with the columns of skimage.measure.regionprops_table
+    for label, centroid, area, equivalent_diameter_area and bbox, and the
+    fraction of pixels covered by objects.
+
+    images: intensity channels, possibly lazy, of the same shape as labels.
+    Adds <channel>_mean, <channel>_max and <channel>_integrated columns
+    for each channel. Only the rows of the current chunk are read."""
+    n = int(labels.max()) + 1 if labels.size > 0 else 1
+    chunk_rows = max(1, chunk_pixels // max(1, labels.shape[1]))
+    starts = range(0, labels.shape[0], chunk_rows)
+
+    channels = dict()
+    for channel, image in images.items():
+        if image.shape != labels.shape:
+            logging.warning(f"{channel} image shape {image.shape} differs from objects, skipping intensity features")
+            continue
+        channels[channel] = image
+
+    def reduce(group):
+        # Each thread keeps a running total, bounding memory to one total per thread
+        totals = None
+        for row0 in group:
+            rows = slice(row0, row0 + chunk_rows)
+            chunk_images = {channel: np.asarray(image[rows]) for channel, image in channels.items()}
+            chunk = chunk_features(np.asarray(labels[rows]), row0, n, chunk_images)
+            totals = chunk if totals is None else combine(totals, chunk)
+        return totals
+
+    n_workers = max(1, min(n_workers, len(starts)))
+    groups = [starts[i::n_workers] for i in range(n_workers)]
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        totals = None
+        for group_totals in pool.map(reduce, groups):
+            totals = group_totals if totals is None else combine(totals, group_totals)
+
+    area = totals["area"]
+    found = np.flatnonzero(area[1:]) + 1
+    area_found = area[found].astype(np.float64)
+
+    features = pd.DataFrame({
+        "label": found,
+        "centroid-0": totals["sum_row"][found] / area_found,
+        "centroid-1": totals["sum_col"][found] / area_found,
+        "area": area_found,
+        "equivalent_diameter_area": np.sqrt(4 * area_found / np.pi),
+        "bbox-0": totals["min_row"][found],
+        "bbox-1": totals["min_col"][found],
+        "bbox-2": totals["max_row"][found] + 1,
+        "bbox-3": totals["max_col"][found] + 1,
+    })
+
+    for channel in channels:
+        integrated = totals[f"sum_intensity:{channel}"][found]
+        features[f"{channel}_mean"] = integrated / area_found
+        features[f"{channel}_max"] = totals[f"max_intensity:{channel}"][found]
+        features[f"{channel}_integrated"] = integrated
+
+    coverage = area[1:].sum() / labels.size if labels.size > 0 else 0.0
+    return features, coverage
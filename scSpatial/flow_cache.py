@@ -0,0 +1,58 @@
+from collections import OrderedDict
+import logging
+
+MAX_FLOW_CACHE_BYTES = 4 * 1024**3 # flows kept in memory before the oldest are dropped
+
+
+class FlowCache:
+    """In memory LRU cache of Cellpose network outputs.
+
+    Flows and cell probabilities only depend on the image and the network
+    settings, so they are reused when only the flow or mask threshold change.
+    Entries are lists of per tile flows as returned by cellpose_flows.
+    """
+
+    def __init__(self, max_bytes: int = MAX_FLOW_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.sizes: dict = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def fits(self, nbytes: int) -> bool:
+        """returns True if flows of nbytes can be cached"""
+        return nbytes <= self.max_bytes
+
+    def get(self, key):
+        """returns flows stored under key, or None"""
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, flows: list):
+        """stores flows under key, dropping the least recently used entries if needed"""
+        size = sum(tile["dP"].nbytes + tile["cellprob"].nbytes for tile in flows)
+        if size > self.max_bytes:
+            logging.info("flows are larger than the flow cache, not cached")
+            return
+
+        self.entries[key] = flows
+        self.sizes[key] = size
+        self.entries.move_to_end(key)
+        while self.nbytes > self.max_bytes:
+            oldest, _ = self.entries.popitem(last=False)
+            self.sizes.pop(oldest)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+
+
+# Shared by all segmentations in the process
+flow_cache = FlowCache()
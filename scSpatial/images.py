@@ -0,0 +1,188 @@
+from imageio import v3 as imageio
+import hashlib
+import logging
+import os
+import numpy as np
+import tifffile
+import zarr
+
+from .jobs import report
+
+from typing import List, Tuple
+
+TIFF_SUFFIXES = (".tif", ".tiff")
+ZARR_SUFFIXES = (".zarr",)
+CONTRAST_SAMPLE_SIZE = 1000 # max side of the image sampled to estimate contrast
+PYRAMID_MIN_SIZE = 1024 # pyramid levels are halved until they fit this size
+PYRAMID_BLOCK_SIZE = 2048 # side of the output block written per read when downsampling
+PYRAMID_CHUNK_SIZE = 512 # chunk side of cached pyramid levels
+PYRAMID_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "scSpatial", "pyramids")
+
+
+def open_image(path: str):
+    """Opens an image without reading all pixels into memory.
+
+    Uncompressed contiguous TIFF files are memory-mapped. Tiled or
+    compressed TIFF, OME-TIFF and Zarr are opened as zarr arrays that
+    only read the chunks being sliced. Other formats are read with imageio.
+    Returns an array-like object supporting numpy slicing.
+    """
+    name = str(path).lower().rstrip("/")
+
+    if name.endswith(ZARR_SUFFIXES):
+        return open_zarr(path)
+
+    if name.endswith(TIFF_SUFFIXES):
+        return open_tiff(path)
+
+    return imageio.imread(path)
+
+
+def open_tiff(path: str):
+    """Memory-maps a contiguous TIFF, otherwise opens it chunk by chunk"""
+    with tifffile.TiffFile(path) as tif:
+        # dataoffset is only set when the image is stored uncompressed in one block
+        memmappable = tif.series[0].dataoffset is not None
+
+    if memmappable:
+        return tifffile.memmap(path, series=0, mode="r")
+
+    # Full resolution level of the first series (OME-TIFF may hold a pyramid)
+    store = tifffile.imread(path, aszarr=True, series=0, level=0)
+    return zarr.open(store, mode="r")
+
+
+def open_zarr(path: str):
+    """Opens a zarr array, or the full resolution level of a multiscale group"""
+    image = zarr.open(path, mode="r")
+    if isinstance(image, zarr.Group):
+        # OME-Zarr stores the full resolution level under the first dataset
+        datasets = image.attrs.get("multiscales", [{}])[0].get("datasets", [{"path": "0"}])
+        image = image[datasets[0]["path"]]
+    return image
+
+
+def contrast_limits(image) -> Tuple[float, float]:
+    """Estimates contrast limits from a strided sample of the image,
+    avoiding a scan of every pixel of large images"""
+    step = max(1, max(image.shape[:2]) // CONTRAST_SAMPLE_SIZE)
+    sample = np.asarray(image[::step, ::step])
+    return float(np.min(sample)), float(np.max(sample))
+
+
+def pyramid_path(path: str) -> str:
+    """returns the location of the pyramid cache next to the source image"""
+    return f"{str(path).rstrip('/')}.pyramid.zarr"
+
+
+def user_pyramid_path(path: str) -> str:
+    """returns the location of the pyramid cache in the user cache directory,
+    used when the folder of the source image is not writable"""
+    key = hashlib.blake2b(os.path.abspath(str(path)).encode(), digest_size=16).hexdigest()
+    return os.path.join(PYRAMID_CACHE_DIR, f"{key}.pyramid.zarr")
+
+
+def image_pyramid(image, path: str) -> List:
+    """Returns a multiscale pyramid of the image, from full to coarse resolution.
+
+    The full resolution level is the image itself. Coarser levels are halved
+    until they fit PYRAMID_MIN_SIZE and are cached on disk next to the source
+    file, so reopening the image reuses them. The cache is rebuilt if the
+    source file changes. If the folder of the source is read-only the cache
+    is kept in the user cache directory, and if that fails too the pyramid
+    is built in memory.
+    """
+    source = os.stat(path)
+    identity = dict(
+        shape=list(image.shape),
+        dtype=str(image.dtype),
+        mtime=source.st_mtime,
+        size=source.st_size,
+    )
+    caches = [pyramid_path(path), user_pyramid_path(path)]
+
+    for cache in caches:
+        if os.path.exists(cache):
+            root = zarr.open_group(cache, mode="r")
+            if root.attrs.get("source") == identity:
+                return [image] + [root[str(i)] for i in range(1, root.attrs["levels"])]
+
+    logging.info(f"building image pyramid for {path}")
+    for cache in caches:
+        try:
+            return build_pyramid(image, zarr.open_group(cache, mode="w"), identity)
+        except OSError as error:
+            logging.warning(f"can not write image pyramid to {cache}: {error}")
+
+    return build_pyramid(image, zarr.group(), identity)
+
+
+def build_pyramid(image, root, identity: dict) -> List:
+    """writes the coarser levels of the image to root, returns all levels"""
+    levels = [image]
+    while max(levels[-1].shape[:2]) > PYRAMID_MIN_SIZE:
+        report("building image pyramid")
+        levels.append(write_downsampled(levels[-1], root, name=str(len(levels))))
+
+    # Written last so an interrupted build is not reused
+    root.attrs["levels"] = len(levels)
+    root.attrs["source"] = identity
+    return levels
+
+
+def write_downsampled(image, root, name: str):
+    """writes the image at half resolution to root[name], one block at a time"""
+    shape = tuple((n + 1) // 2 for n in image.shape[:2]) + tuple(image.shape[2:])
+    level = root.zeros(
+        name=name,
+        shape=shape,
+        chunks=(PYRAMID_CHUNK_SIZE, PYRAMID_CHUNK_SIZE) + tuple(image.shape[2:]),
+        dtype=image.dtype,
+    )
+
+    # Blocks are even sized so each output pixel pools pixels of one block
+    block = 2 * PYRAMID_BLOCK_SIZE
+    for r in range(0, image.shape[0], block):
+        for c in range(0, image.shape[1], block):
+            pooled = mean_pool(np.asarray(image[r:r + block, c:c + block]))
+            level[r // 2:r // 2 + pooled.shape[0], c // 2:c // 2 + pooled.shape[1]] = pooled
+    return level
+
+
+def mean_pool(block: np.ndarray) -> np.ndarray:
+    """halves the resolution of the first two axes by averaging 2x2 pixels"""
+    dtype = block.dtype
+    h, w = block.shape[:2]
+    pad = ((0, h % 2), (0, w % 2)) + ((0, 0),) * (block.ndim - 2)
+    block = np.pad(block, pad, mode="edge").astype(np.float32)
+
+    pooled = (block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2]) / 4
+    if np.issubdtype(dtype, np.integer):
+        pooled = np.rint(pooled)
+    return pooled.astype(dtype)
+
+
+def label_pyramid(labels: np.ndarray, min_size: int = PYRAMID_MIN_SIZE) -> List[np.ndarray]:
+    """Returns a multiscale pyramid of a label image, from full to coarse resolution.
+
+    The full resolution level is the label image itself, no copy is made.
+    Each coarser level halves the resolution with pool_labels until it fits
+    min_size."""
+    levels = [labels]
+    while max(levels[-1].shape[:2]) > min_size:
+        levels.append(pool_labels(levels[-1]))
+    return levels
+
+
+def pool_labels(labels: np.ndarray) -> np.ndarray:
+    """Halves the resolution of a label image without mixing labels.
+
+    Each output pixel takes the first nonzero label of its 2x2 block, so
+    small objects are kept as long as they are not hidden by neighbours."""
+    pooled = labels[0::2, 0::2].copy()
+
+    # Fill background from the other pixels of each block
+    for shifted in (labels[1::2, 0::2], labels[0::2, 1::2], labels[1::2, 1::2]):
+        empty = pooled[:shifted.shape[0], :shifted.shape[1]] == 0
+        pooled[:shifted.shape[0], :shifted.shape[1]][empty] = shifted[empty]
+    return pooled
@@ -0,0 +1,120 @@
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+from collections import deque
+import logging
+import threading
+
+from typing import Callable
+
+# Job running in the current thread, used by report()
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled"""
+
+
+def report(stage: str, done: int = 0, total: int = 0):
+    """Report progress of the job running in this thread.
+
+    Raises JobCancelled if the job has been cancelled, so long running
+    code should call this between steps. Does nothing outside of a job."""
+    job = getattr(_local, "job", None)
+    if job is not None:
+        job.report(stage, done, total)
+
+
+class Job(QThread):
+    """Runs function(*args, **kwargs) in a worker thread.
+
+    The result is emitted with returned, in the thread of the receiver,
+    so connected slots may update the viewer."""
+
+    progress = pyqtSignal(str, int, int)
+    returned = pyqtSignal(object)
+    errored = pyqtSignal(object)
+    cancelled = pyqtSignal()
+
+    def __init__(self, name: str, function: Callable, *args, **kwargs):
+        super().__init__()
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.is_cancelled = False
+
+    def __repr__(self):
+        return f"Job: {self.name}"
+
+    def run(self):
+        _local.job = self
+        try:
+            result = self.function(*self.args, **self.kwargs)
+        except JobCancelled:
+            logging.info(f"{self.name} cancelled")
+            self.cancelled.emit()
+        except Exception as error:
+            logging.exception(f"{self.name} failed")
+            self.errored.emit(error)
+        else:
+            self.returned.emit(result)
+        finally:
+            _local.job = None
+
+    def cancel(self):
+        """Request cancellation, the job stops at its next report"""
+        self.is_cancelled = True
+
+    def report(self, stage: str, done: int = 0, total: int = 0):
+        if self.is_cancelled:
+            raise JobCancelled(self.name)
+        self.progress.emit(stage, done, total)
+
+
+class JobScheduler(QObject):
+    """Runs submitted jobs one at a time, in submission order"""
+
+    job_started = pyqtSignal(object)
+    job_finished = pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.queue: deque = deque()
+        self.current: Job = None
+
+    def submit(self, job: Job) -> Job:
+        """Queue a job, it starts when the previous jobs are finished"""
+        job.finished.connect(self._job_finished)
+        self.queue.append(job)
+        if self.current is None:
+            self._start_next()
+        return job
+
+    def cancel(self):
+        """Cancel the running job and all queued jobs"""
+        self.queue.clear()
+        if self.current is not None:
+            self.current.cancel()
+
+    def _start_next(self):
+        if self.queue:
+            self.current = self.queue.popleft()
+            self.job_started.emit(self.current)
+            self.current.start()
+
+    def _job_finished(self):
+        job = self.current
+        job.wait()
+        self.current = None
+        self.job_finished.emit(job)
+        self._start_next()
+
+
+_scheduler: JobScheduler = None
+
+
+def get_scheduler() -> JobScheduler:
+    """returns the scheduler shared by all widgets"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler()
+    return _scheduler
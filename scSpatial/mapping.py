@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from typing import Iterable, Tuple
+
+BATCH_SIZE = 5_000_000 # number of spots gathered from the label image at once
+
+
+def lookup_objects(objects: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """returns the object id under each (x, y) position.
+    Positions outside of the label image are mapped to background (0)"""
+    col = np.asarray(x).astype(np.intp)
+    row = np.asarray(y).astype(np.intp)
+
+    inside = (row >= 0) & (row < objects.shape[0]) & (col >= 0) & (col < objects.shape[1])
+    object_ids = np.zeros(row.shape, dtype=np.int64)
+
+    # One fancy-index gather over the label image for all spots
+    object_ids[inside] = objects[row[inside], col[inside]]
+    return object_ids
+
+
+def encode_genes(genes: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+    """returns integer codes for each spot and the gene names they refer to"""
+    genes = genes.astype("category").cat.remove_unused_categories()
+    return genes.cat.codes.to_numpy(), pd.Index(genes.cat.categories, name="gene")
+
+
+def count_genes(object_ids: np.ndarray, gene_codes: np.ndarray, n_objects: int, n_genes: int) -> sparse.csr_matrix:
+    """accumulate spots into an object x gene count matrix.
+    Row 0 holds spots mapped to background"""
+    counts = sparse.coo_matrix(
+        (np.ones(len(object_ids), dtype=np.int32), (object_ids, gene_codes)),
+        shape=(n_objects, n_genes),
+    )
+    # Duplicated (object, gene) entries are summed during conversion
+    return counts.tocsr()
+
+
+def map_spots(
+    objects: np.ndarray,
+    spots: pd.DataFrame,
+    batch_size: int = BATCH_SIZE
+) -> Tuple[np.ndarray, sparse.csr_matrix, pd.Index]:
+    """map spots with columns x, y and gene to the objects of a label image.
+
+    returns the object id of each spot, the object x gene count matrix
+    (row index equals object id, row 0 is background) and the gene names"""
+    gene_codes, genes = encode_genes(spots.gene)
+    x = spots.x.to_numpy()
+    y = spots.y.to_numpy()
+
+    n_objects = int(objects.max()) + 1 if objects.size > 0 else 1
+    object_ids = np.empty(len(spots), dtype=np.int64)
+    counts = sparse.csr_matrix((n_objects, len(genes)), dtype=np.int32)
+
+    # Gather and accumulate in batches to bound temporary memory
+    for start in range(0, len(spots), batch_size):
+        stop = start + batch_size
+        ids = lookup_objects(objects, x[start:stop], y[start:stop])
+        object_ids[start:stop] = ids
+        counts += count_genes(ids, gene_codes[start:stop], n_objects, len(genes))
+
+    return object_ids, counts, genes
+
+
+class GeneCoder:
+    """Assigns integer codes to gene names consistently across chunks"""
+
+    def __init__(self):
+        self.genes: list = list()
+        self.codes: dict = dict()
+
+    def __len__(self):
+        return len(self.genes)
+
+    def encode(self, genes: pd.Series) -> np.ndarray:
+        """returns the code of the gene of each spot, new genes get the next free code"""
+        genes = genes.astype("category")
+        for name in genes.cat.categories:
+            if name not in self.codes:
+                self.codes[name] = len(self.genes)
+                self.genes.append(name)
+
+        # Translate chunk category codes to global codes
+        lookup = np.array([self.codes[name] for name in genes.cat.categories], dtype=np.int64)
+        return lookup[genes.cat.codes.to_numpy()]
+
+
+def map_spots_streaming(
+    objects: np.ndarray,
+    chunks: Iterable[pd.DataFrame],
+    output_path: str = None
+) -> Tuple[sparse.csr_matrix, pd.Index]:
+    """map chunks of spots with columns x, y and gene to the objects of a label image.
+
+    Only one chunk is held in memory at a time. If output_path is given,
+    the spots and their object id are written to a Parquet file chunk by
+    chunk. returns the object x gene count matrix (row index equals object
+    id, row 0 is background) and the gene names, sorted as in map_spots"""
+    n_objects = int(objects.max()) + 1 if objects.size > 0 else 1
+    coder = GeneCoder()
+    counts = sparse.csr_matrix((n_objects, 0), dtype=np.int32)
+    writer = None
+
+    for chunk in chunks:
+        gene_codes = coder.encode(chunk.gene)
+        object_ids = lookup_objects(objects, chunk.x.to_numpy(), chunk.y.to_numpy())
+
+        # New genes in this chunk add columns
+        if len(coder) > counts.shape[1]:
+            counts.resize((n_objects, len(coder)))
+        counts = counts + count_genes(object_ids, gene_codes, n_objects, len(coder))
+
+        if output_path is not None:
+            writer = write_object_ids(writer, output_path, chunk, object_ids)
+
+    if writer is not None:
+        writer.close()
+
+    # Sort genes by name so columns match map_spots
+    order = np.argsort(np.asarray(coder.genes, dtype=object))
+    genes = pd.Index(np.asarray(coder.genes, dtype=object)[order], name="gene")
+    return counts[:, order].tocsr(), genes
+
+
+def write_object_ids(writer, path: str, chunk: pd.DataFrame, object_ids: np.ndarray):
+    """append spots of a chunk and their object id to a Parquet file,
+    returns the writer to use for the next chunk"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.table({
+        "x": pa.array(chunk.x.to_numpy(), type=pa.float32()),
+        "y": pa.array(chunk.y.to_numpy(), type=pa.float32()),
+        "gene": pa.array(chunk.gene.astype(str).to_numpy(), type=pa.string()),
+        "object_id": pa.array(object_ids, type=pa.int64()),
+    })
+    if writer is None:
+        writer = pq.ParquetWriter(path, table.schema)
+    writer.write_table(table)
+    return writer
@@ -0,0 +1,53 @@
+from cellpose import models
+import logging
+import threading
+
+from typing import Iterable
+
+# Process-wide Cellpose models keyed by (model type, device)
+_models: dict = dict()
+_lock = threading.Lock()
+
+
+def default_device() -> str:
+    """returns "cuda" if a GPU is available, else "cpu\""""
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_model(model_type: str, device: str = None) -> models.Cellpose:
+    """Returns the Cellpose model of model_type on device.
+    Models are loaded on first use and shared by every caller in the process"""
+    import torch
+
+    device = device or default_device()
+    key = (model_type, device)
+
+    with _lock:
+        if key not in _models:
+            logging.info(f"loading Cellpose model {model_type} on {device}")
+            _models[key] = models.Cellpose(
+                model_type=model_type,
+                gpu=device != "cpu",
+                device=torch.device(device)
+            )
+        return _models[key]
+
+
+def warm_up(model_types: Iterable[str] = ("nuclei", "cyto"), device: str = None) -> threading.Thread:
+    """Loads models in a background thread so the first segmentation does not wait for them"""
+
+    def load():
+        for model_type in model_types:
+            get_model(model_type, device)
+
+    thread = threading.Thread(target=load, name="cellpose warm up", daemon=True)
+    thread.start()
+    return thread
+
+
+def clear():
+    """removes all loaded models"""
+    with _lock:
+        _models.clear()
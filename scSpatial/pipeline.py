@@ -0,0 +1,229 @@
+"""Headless batch processing of many samples, without napari.
+
+Usage: scSpatial-batch manifest.json --output results --workers 4
+
+The manifest is a JSON list of samples (or {"samples": [...]}), e.g.
+
+    {
+        "name": "slide1",
+        "images": {"Nuclei": "slide1_dapi.tif", "Cytoplasm": "slide1_cyto.tif"},
+        "transcripts": {"path": "slide1_spots.parquet", "x": "PosX", "y": "PosY", "gene": "Gene"},
+        "segmentation": {"method": "cytoplasm", "settings": {"size": 120}},
+        "reference": {"path": "atlas.h5ad", "groupby": "cluster", "method": "bonefight"}
+    }
+
+transcripts may set "stream": true to map files larger than memory.
+segmentation methods are "nuclei", "cytoplasm" or "external" with a
+"path" to a label image. reference methods are "bonefight", "correlation"
+or "nnls", with optional "settings" passed to the transfer class.
+
+Each sample is written to <output>/<name>/: a project (project.zarr), the
+export (<name>.h5ad and <name>.spots.parquet) and a log (pipeline.log).
+Finished samples are skipped when the pipeline is rerun, and a sample with
+a saved project resumes after segmentation.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from typing import List
+
+from .analysis import Bonefight, ScoreTransfer, read_reference
+from .dataset import Dataset
+from .export import export_segmentation
+from .images import open_image
+from .project import load_project, save_project
+from .segmentation import Segmentation, segmentCytoplasm, segmentNuclei
+from .tiling import _init_worker
+from .transcripts import TranscriptFile, read_transcripts
+
+SEGMENTATION_METHODS = dict(nuclei=segmentNuclei, cytoplasm=segmentCytoplasm)
+TRANSFER_METHODS = ("bonefight", "correlation", "nnls")
+PROJECT = "project.zarr" # project of a sample, saved after segmentation and label transfer
+DONE = "done.json" # written when a sample is finished
+LOG = "pipeline.log" # log of a sample
+
+
+def read_manifest(path: str) -> List[dict]:
+    """reads and checks the samples of a manifest"""
+    with open(path) as f:
+        samples = json.load(f)
+    if isinstance(samples, dict):
+        samples = samples["samples"]
+
+    names = set()
+    for sample in samples:
+        for key in ("name", "images", "segmentation"):
+            if key not in sample:
+                raise ValueError(f"sample {sample.get('name')} has no {key}")
+        if sample["name"] in names:
+            raise ValueError(f"sample name {sample['name']} is not unique")
+        names.add(sample["name"])
+
+        method = sample["segmentation"]["method"]
+        if method not in SEGMENTATION_METHODS and method != "external":
+            raise ValueError(f"unknown segmentation method {method} of {sample['name']}")
+        if "reference" in sample and sample["reference"].get("method", "bonefight") not in TRANSFER_METHODS:
+            raise ValueError(f"unknown label transfer method of {sample['name']}")
+    return samples
+
+
+def load_sample(dataset: Dataset, sample: dict):
+    """loads the images and transcripts of a sample into dataset"""
+    for channel, path in sample["images"].items():
+        dataset.load_other_channel(channel=channel, path=path)
+
+    transcripts = sample.get("transcripts")
+    if transcripts is not None:
+        columns = dict(x=transcripts.get("x", "x"), y=transcripts.get("y", "y"), gene=transcripts.get("gene", "gene"))
+        if transcripts.get("stream", False):
+            dataset.add_transcript_file(TranscriptFile(transcripts["path"], **columns))
+        else:
+            dataset.add_gene_expression(read_transcripts(transcripts["path"], **columns))
+
+
+def segment(dataset: Dataset, settings: dict) -> Segmentation:
+    """segments dataset, gene mapping and object features run with it"""
+    method = settings["method"]
+    if method == "external":
+        objects = np.asarray(open_image(settings["path"])).astype(int)
+        return Segmentation(
+            dataset=dataset,
+            type="External",
+            objects=objects,
+            settings={"name": os.path.basename(settings["path"])}
+        )
+    return SEGMENTATION_METHODS[method](dataset, **settings.get("settings", dict()))
+
+
+def transfer_labels(seg: Segmentation, settings: dict):
+    """returns cell types of seg predicted from a reference"""
+    reference = read_reference(settings["path"])
+    method = settings.get("method", "bonefight")
+    kwargs = dict(
+        segmentation=seg,
+        reference=reference,
+        groupby=settings["groupby"],
+        reference_path=settings["path"],
+        **settings.get("settings", dict())
+    )
+    if method == "bonefight":
+        return Bonefight(**kwargs).transfer_labels()
+    return ScoreTransfer(method=method, **kwargs).transfer_labels()
+
+
+def run_sample(sample: dict, output_dir: str) -> str:
+    """Runs load, segmentation, gene mapping, object features, label
+    transfer and export of a sample. returns the folder of the sample"""
+    folder = os.path.join(output_dir, sample["name"])
+    os.makedirs(folder, exist_ok=True)
+    if os.path.exists(os.path.join(folder, DONE)):
+        logging.info(f"{sample['name']} is done, skipping")
+        return folder
+
+    handler = logging.FileHandler(os.path.join(folder, LOG))
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logging.getLogger().addHandler(handler)
+    start = time.perf_counter()
+    try:
+        dataset = Dataset(sample["name"])
+        project = os.path.join(folder, PROJECT)
+
+        if os.path.exists(project):
+            logging.info(f"resuming {sample['name']} from {project}")
+            load_project(project, dataset)
+            seg = dataset.active_segmentation
+        else:
+            logging.info(f"loading {sample['name']}")
+            load_sample(dataset, sample)
+            logging.info(f"segmenting {sample['name']}")
+            seg = segment(dataset, sample["segmentation"])
+            dataset.set_active_segmentation(seg)
+            save_project(dataset, project)
+
+        if "reference" in sample and seg.cell_types is None:
+            logging.info(f"transferring labels to {sample['name']}")
+            seg.add_cell_types(transfer_labels(seg, sample["reference"]))
+            save_project(dataset, project)
+
+        logging.info(f"exporting {sample['name']}")
+        export_segmentation(seg, os.path.join(folder, f"{sample['name']}.h5ad"))
+
+        # Written last, marks the sample as finished
+        with open(os.path.join(folder, DONE), "w") as f:
+            json.dump(dict(
+                objects=len(seg.object_features),
+                object_coverage=float(seg.object_coverage),
+                seconds=time.perf_counter() - start,
+            ), f)
+        logging.info(f"{sample['name']} done in {time.perf_counter() - start:.0f} s")
+        return folder
+
+    except Exception:
+        logging.exception(f"{sample['name']} failed")
+        raise
+
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+
+def _init_sample_worker(threads: int):
+    """Samples run in parallel, so each runs its tiles in its own process"""
+    logging.getLogger().setLevel(logging.INFO)
+    _init_worker(threads)
+    Segmentation.n_workers = 1
+
+
+def run_pipeline(manifest: str, output_dir: str, n_workers: int = 1) -> dict:
+    """Runs every sample of a manifest in a pool of n_workers processes.
+    returns the folder of each finished sample, or the error it failed with"""
+    samples = read_manifest(manifest)
+    os.makedirs(output_dir, exist_ok=True)
+
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    results = dict()
+
+    # Spawned, not forked, as torch and open zarr stores are not fork safe
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_sample_worker,
+        initargs=(threads,)
+    ) as pool:
+        futures = {pool.submit(run_sample, sample, output_dir): sample["name"] for sample in samples}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+                logging.info(f"finished {name}")
+            except Exception as error:
+                results[name] = error
+                logging.error(f"{name} failed: {error}, see {os.path.join(output_dir, name, LOG)}")
+    return results
+
+
+def main(argv: List[str] = None):
+    "Entry point for batch processing from the command line"
+    parser = argparse.ArgumentParser(description="Process samples of a manifest without the napari viewer")
+    parser.add_argument("manifest", help="JSON file listing the samples")
+    parser.add_argument("-o", "--output", default="scSpatial_output", help="folder the samples are written to")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="samples processed in parallel")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    results = run_pipeline(args.manifest, args.output, args.workers)
+
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+    logging.info(f"{len(results) - len(failed)} samples done, {len(failed)} failed")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import zarr
+
+from .expression import GeneExpression
+from .images import PYRAMID_BLOCK_SIZE, PYRAMID_CHUNK_SIZE, open_image
+from .jobs import report
+from .transcripts import TranscriptFile
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .dataset import Dataset
+    from .segmentation import Segmentation
+
+PROJECT_VERSION = 1 # bumped when the layout of saved projects changes
+TABLES = "tables" # folder of the project holding Parquet tables
+
+
+def save_project(dataset: "Dataset", path: str):
+    """Saves a dataset and its segmentations to a project folder.
+
+    Arrays are written to a chunked, compressed Zarr group and tables to
+    Parquet files, so load_project can read them lazily. Images are saved
+    as a reference to their source file, or as arrays when cropped or
+    loaded without a file. The project is written to a temporary folder
+    and moved in place, so a project can be saved over itself."""
+    path = str(path).rstrip("/")
+    tmp = f"{path}.tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+
+    root = zarr.open_group(tmp, mode="w")
+    tables = os.path.join(tmp, TABLES)
+    os.makedirs(tables)
+
+    # Images
+    image_paths = dict()
+    images = root.create_group("images")
+    for channel, image in dataset.images.items():
+        source = dataset.image_paths.get(channel)
+        if source and dataset.translate == (0, 0):
+            image_paths[channel] = os.path.abspath(source)
+        else:
+            write_array(images, channel, image)
+
+    # Genes
+    transcript_file = None
+    if isinstance(dataset.gene_expression, pd.DataFrame):
+        dataset.gene_expression.to_parquet(os.path.join(tables, "gene_expression.parquet"))
+    elif dataset.transcript_file is not None:
+        tf = dataset.transcript_file
+        transcript_file = dict(
+            path=os.path.abspath(tf.path), x=tf.x, y=tf.y, gene=tf.gene, chunk_size=tf.chunk_size
+        )
+
+    # Segmentations
+    segmentations = root.create_group("segmentations")
+    for seg in dataset.segmentation.values():
+        save_segmentation(seg, segmentations.create_group(str(seg.id)), tables)
+
+    active = dataset.active_segmentation
+    root.attrs["project"] = dict(
+        version=PROJECT_VERSION,
+        name=dataset.name,
+        translate=list(dataset.translate),
+        image_paths=image_paths,
+        transcript_file=transcript_file,
+        segmentations=list(dataset.segmentation.keys()),
+        active_segmentation=active.id if active is not None else None,
+    )
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def save_segmentation(seg: "Segmentation", group, tables: str):
+    """writes the objects pyramid, gene expression and tables of a segmentation"""
+    prefix = os.path.join(tables, f"segmentation_{seg.id}")
+
+    pyramid = seg.pyramid if seg.pyramid is not None else [seg.objects]
+    objects = group.create_group("objects")
+    for level, labels in enumerate(pyramid):
+        write_array(objects, str(level), labels)
+
+    if seg.gene_expression is not None:
+        save_gene_expression(seg.gene_expression, group.create_group("gene_expression"))
+
+        genes = pd.DataFrame({
+            "background": seg.background,
+            "pct_mapped_genes": seg.pct_mapped_genes,
+        })
+        genes.to_parquet(f"{prefix}.genes.parquet")
+
+    if seg.object_features is not None:
+        seg.object_features.to_parquet(f"{prefix}.object_features.parquet")
+
+    if seg.cell_types is not None:
+        seg.cell_types.to_parquet(f"{prefix}.cell_types.parquet")
+
+    downsampled_level = None
+    if seg.downsampled is not None:
+        downsampled_level = int(np.log2(seg.downsampled[1]))
+
+    group.attrs["segmentation"] = dict(
+        id=seg.id,
+        type=seg.type,
+        settings=seg.settings,
+        object_coverage=None if seg.object_coverage is None else float(seg.object_coverage),
+        object_mapping_path=seg.object_mapping_path,
+        downsampled_level=downsampled_level,
+    )
+
+
+def save_gene_expression(gene_expression: GeneExpression, group):
+    """writes the sparse count matrix as its CSR arrays"""
+    matrix = gene_expression.matrix
+    for name in ("data", "indices", "indptr"):
+        write_array(group, name, getattr(matrix, name))
+    write_array(group, "index", np.asarray(gene_expression.index, dtype=np.int64))
+    group.attrs["shape"] = list(matrix.shape)
+    group.attrs["columns"] = [str(gene) for gene in gene_expression.columns]
+
+
+def write_array(group, name: str, array):
+    """writes an array, possibly lazy, to group[name] in chunks.
+    Images are chunked in tiles and read one block of rows at a time"""
+    if array.ndim == 1:
+        group.zeros(name=name, shape=array.shape, chunks=(1024**2,), dtype=array.dtype)[:] = np.asarray(array)
+        return
+
+    stored = group.zeros(
+        name=name,
+        shape=array.shape,
+        chunks=(PYRAMID_CHUNK_SIZE, PYRAMID_CHUNK_SIZE) + tuple(array.shape[2:]),
+        dtype=array.dtype,
+    )
+    for row in range(0, array.shape[0], PYRAMID_BLOCK_SIZE):
+        stored[row:row + PYRAMID_BLOCK_SIZE] = np.asarray(array[row:row + PYRAMID_BLOCK_SIZE])
+
+
+def load_project(path: str, dataset: "Dataset") -> "Dataset":
+    """Loads a project saved with save_project into dataset.
+
+    Images and label images are opened lazily, so only the chunks shown in
+    the viewer or used by an analysis are read. Gene expression, object
+    features and cell types are read from their columnar files, which
+    takes a while for large projects, so the viewer runs this in a job."""
+    from .segmentation import Segmentation
+
+    path = str(path).rstrip("/")
+    root = zarr.open_group(path, mode="r")
+    attrs = root.attrs["project"]
+    tables = os.path.join(path, TABLES)
+
+    if dataset.all.get(dataset.name) is dataset:
+        del dataset.all[dataset.name]
+    dataset.name = attrs["name"]
+    dataset.all[dataset.name] = dataset
+    dataset.translate = tuple(attrs["translate"])
+
+    # Images
+    dataset.images.clear()
+    dataset.image_paths.clear()
+    dataset.image_sources.clear()
+    dataset.pyramids.clear()
+    for channel, source in attrs["image_paths"].items():
+        if not os.path.exists(source):
+            logging.warning(f"image {source} of {channel} not found, skipping")
+            continue
+        dataset.images[channel] = open_image(source)
+        dataset.image_paths[channel] = source
+        dataset.image_sources[channel] = (source, (0, 0))
+    for channel in root["images"].array_keys():
+        dataset.images[channel] = root["images"][channel]
+
+    # Genes
+    report("reading genes")
+    genes_path = os.path.join(tables, "gene_expression.parquet")
+    if os.path.exists(genes_path):
+        dataset.add_gene_expression(pd.read_parquet(genes_path))
+    elif attrs["transcript_file"] is not None:
+        dataset.add_transcript_file(TranscriptFile(**attrs["transcript_file"]))
+
+    # Segmentations
+    report("reading segmentations")
+    for seg in list(dataset.segmentation.values()):
+        dataset.remove_segmentation(seg)
+    for seg_id in attrs["segmentations"]:
+        seg = load_segmentation(root["segmentations"][str(seg_id)], dataset, tables, Segmentation)
+        dataset.add_segmentation(seg)
+
+    if attrs["active_segmentation"] is not None:
+        dataset.set_active_segmentation(dataset.segmentation[attrs["active_segmentation"]])
+
+    return dataset
+
+
+def load_segmentation(group, dataset: "Dataset", tables: str, cls) -> "Segmentation":
+    """restores a segmentation, keeping its objects pyramid on disk"""
+    attrs = group.attrs["segmentation"]
+    prefix = os.path.join(tables, f"segmentation_{attrs['id']}")
+
+    objects = group["objects"]
+    pyramid = [objects[str(level)] for level in range(len(list(objects.array_keys())))]
+
+    seg = cls.restore(dataset, attrs["id"], attrs["type"], attrs["settings"], pyramid[0])
+    seg.pyramid = pyramid
+    seg.object_coverage = attrs["object_coverage"]
+    seg.object_mapping_path = attrs["object_mapping_path"]
+
+    if attrs["downsampled_level"] is not None:
+        level = attrs["downsampled_level"]
+        seg.downsampled = (np.asarray(pyramid[level]), float(2 ** level))
+
+    if "gene_expression" in group:
+        seg.gene_expression = load_gene_expression(group["gene_expression"])
+        genes = pd.read_parquet(f"{prefix}.genes.parquet")
+        seg.background = genes["background"]
+        seg.pct_mapped_genes = genes["pct_mapped_genes"]
+
+    if os.path.exists(f"{prefix}.object_features.parquet"):
+        seg.object_features = pd.read_parquet(f"{prefix}.object_features.parquet")
+
+    if os.path.exists(f"{prefix}.cell_types.parquet"):
+        seg.cell_types = pd.read_parquet(f"{prefix}.cell_types.parquet")
+
+    return seg
+
+
+def load_gene_expression(group) -> GeneExpression:
+    """reads a count matrix written by save_gene_expression"""
+    matrix = sparse.csr_matrix(
+        (group["data"][:], group["indices"][:], group["indptr"][:]),
+        shape=tuple(group.attrs["shape"])
+    )
+    return GeneExpression(matrix, index=group["index"][:], columns=group.attrs["columns"])
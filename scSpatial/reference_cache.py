@@ -0,0 +1,84 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+from typing import Tuple
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "scSpatial", "references")
+
+
+def reference_key(path: str, groupby: str) -> str:
+    """returns the cache key of a reference file, aggregated by groupby.
+    The file is identified by its path, size and modification time"""
+    source = os.stat(path)
+    content = json.dumps(dict(
+        path=os.path.abspath(path),
+        size=source.st_size,
+        mtime=source.st_mtime,
+        groupby=groupby,
+    ))
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+class ReferenceCache:
+    """Persistent cache of aggregated reference profiles.
+
+    Each entry is a .npz file named by its key holding the mean expression
+    (genes x groups), the gene and group names and the number of cells
+    of each group."""
+
+    def __init__(self, path: str = CACHE_DIR):
+        self.path = path
+
+    def __repr__(self):
+        return f"ReferenceCache: {self.path}"
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.npz")
+
+    def get(self, key: str) -> Tuple[pd.DataFrame, pd.Series]:
+        """returns the group means and group sizes stored under key, or None"""
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+
+        logging.info("using cached reference profiles")
+        with np.load(path, allow_pickle=False) as entry:
+            groups = pd.Index(entry["groups"], name=str(entry["groupby"]))
+            means = pd.DataFrame(entry["means"], index=entry["genes"], columns=groups)
+            sizes = pd.Series(entry["sizes"], index=groups)
+        return means, sizes
+
+    def put(self, key: str, means: pd.DataFrame, sizes: pd.Series):
+        """stores genes x groups means and group sizes under key"""
+        os.makedirs(self.path, exist_ok=True)
+
+        # Written to a temporary file and moved so incomplete entries are never read
+        tmp = os.path.join(self.path, f"{key}.tmp.npz")
+        np.savez(
+            tmp,
+            means=means.to_numpy(),
+            genes=means.index.to_numpy().astype(str),
+            groups=plain_array(means.columns),
+            groupby=str(means.columns.name),
+            sizes=sizes[means.columns].to_numpy(),
+        )
+        os.replace(tmp, self.entry_path(key))
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
+
+
+def plain_array(index: pd.Index) -> np.ndarray:
+    """returns index as a numpy array that is stored without pickling"""
+    values = np.asarray(index)
+    return values.astype(str) if values.dtype == object else values
+
+
+# Shared by all label transfers in the process
+reference_cache = ReferenceCache()
@@ -0,0 +1,24 @@
+import numpy as np
+
+
+def label_lut(index: np.ndarray, values: np.ndarray, size: int, dtype=np.float32) -> np.ndarray:
+    """returns a lookup array of length size where lut[label] = value.
+    Labels not in index, including background (0), map to 0"""
+    lut = np.zeros(size, dtype=dtype)
+    lut[np.asarray(index)] = values
+    return lut
+
+
+def render_labels(objects: np.ndarray, index: np.ndarray, values: np.ndarray, dtype=np.float32) -> np.ndarray:
+    """returns an image where each object of the label image is set to its value.
+    Maps the label image through a lookup array in one vectorized pass"""
+    objects = np.asarray(objects)
+    index = np.asarray(index)
+    size = max(int(objects.max()), int(index.max()) if len(index) > 0 else 0) + 1
+    lut = label_lut(index, values, size, dtype)
+    return lut[objects]
+
+
+def count_dtype(values: np.ndarray) -> np.dtype:
+    """returns the smallest unsigned integer dtype holding values"""
+    return np.min_scalar_type(max(int(np.max(values)) if len(values) > 0 else 0, 0))
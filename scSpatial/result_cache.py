@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import zarr
+
+from .jobs import report
+from .project import write_array
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "scSpatial", "segmentations")
+MAX_RESULT_CACHE_BYTES = 20 * 1024**3 # results kept on disk before the least recently used are dropped
+HASH_BLOCK_ROWS = 1024 # rows of an image hashed per read
+
+
+def hash_image(image) -> str:
+    """returns a digest of the pixels, shape and dtype of an image,
+    possibly lazy, read one block of rows at a time. Reports progress
+    per block, so hashing in a job can be cancelled"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([list(image.shape), str(image.dtype)]).encode())
+    for row in range(0, image.shape[0], HASH_BLOCK_ROWS):
+        report("hashing images", row, image.shape[0])
+        block = np.ascontiguousarray(image[row:row + HASH_BLOCK_ROWS])
+        digest.update(block.data)
+    return digest.hexdigest()
+
+
+def result_key(type: str, settings: dict, image_digests: list, **parameters) -> str:
+    """returns the cache key of a segmentation of images with the given digests"""
+    content = json.dumps(
+        dict(type=type, settings=settings, images=image_digests, **parameters),
+        sort_keys=True
+    )
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """Persistent, content-addressed LRU cache of segmentation results.
+
+    Each entry is a folder named by its key, holding the objects as a
+    compressed Zarr array, the object features as Parquet and a meta.json.
+    The modification time of meta.json marks when an entry was last used.
+    """
+
+    def __init__(self, path: str = CACHE_DIR, max_bytes: int = MAX_RESULT_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"ResultCache: {self.path}, {self.hits} hits, {self.misses} misses"
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def entries(self) -> list:
+        """returns (last used, key, size) of every complete entry"""
+        if not os.path.isdir(self.path):
+            return []
+
+        entries = list()
+        for key in os.listdir(self.path):
+            meta = os.path.join(self.path, key, "meta.json")
+            if os.path.exists(meta):
+                with open(meta) as f:
+                    nbytes = json.load(f)["nbytes"]
+                entries.append((os.path.getmtime(meta), key, nbytes))
+        return entries
+
+    @property
+    def nbytes(self) -> int:
+        return sum(nbytes for _, _, nbytes in self.entries())
+
+    def stats(self) -> dict:
+        """returns hit and miss counts of this session, and entries and size on disk"""
+        entries = self.entries()
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(entries),
+            nbytes=sum(nbytes for _, _, nbytes in entries),
+        )
+
+    def get(self, key: str) -> dict:
+        """returns the result stored under key, or None.
+        The result holds objects, object_features, object_coverage and feature_images"""
+        path = self.entry_path(key)
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            self.misses += 1
+            logging.info(f"segmentation cache miss ({self.hits} hits, {self.misses} misses)")
+            return None
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        os.utime(meta_path)
+
+        result = dict(
+            objects=zarr.open_group(os.path.join(path, "objects.zarr"), mode="r")["objects"][:],
+            object_features=None,
+            object_coverage=meta["object_coverage"],
+            feature_images=meta["feature_images"],
+        )
+        features_path = os.path.join(path, "object_features.parquet")
+        if os.path.exists(features_path):
+            result["object_features"] = pd.read_parquet(features_path)
+
+        self.hits += 1
+        logging.info(f"segmentation cache hit ({self.hits} hits, {self.misses} misses)")
+        return result
+
+    def put(self, key: str, objects: np.ndarray, object_features: pd.DataFrame = None,
+            object_coverage: float = None, feature_images: dict = None):
+        """stores a result under key, dropping the least recently used entries if needed.
+
+        feature_images: digest of each image the object features were computed from"""
+        path = self.entry_path(key)
+        tmp = f"{path}.tmp"
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        write_array(zarr.open_group(os.path.join(tmp, "objects.zarr"), mode="w"), "objects", objects)
+
+        if object_features is not None:
+            object_features.to_parquet(os.path.join(tmp, "object_features.parquet"))
+
+        nbytes = folder_size(tmp)
+        if nbytes > self.max_bytes:
+            logging.info("segmentation is larger than the segmentation cache, not cached")
+            shutil.rmtree(tmp)
+            return
+
+        # meta.json is written last so incomplete entries are never read
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(dict(
+                nbytes=nbytes,
+                object_coverage=None if object_coverage is None else float(object_coverage),
+                feature_images=feature_images,
+            ), f)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """drops least recently used entries until the cache fits max_bytes"""
+        entries = sorted(self.entries())
+        total = sum(nbytes for _, _, nbytes in entries)
+        for _, key, nbytes in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= nbytes
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.hits = 0
+        self.misses = 0
+
+
+def folder_size(path: str) -> int:
+    """returns the size in bytes of all files below path"""
+    return sum(
+        os.path.getsize(os.path.join(folder, name))
+        for folder, _, names in os.walk(path)
+        for name in names
+    )
+
+
+# Shared by all segmentations in the process
+result_cache = ResultCache()
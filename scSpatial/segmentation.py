@@ -1,9 +1,26 @@
-from cellpose import models
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import pandas as pd
 import numpy as np
-from skimage import measure
 
-from typing import Tuple
+from .expression import GeneExpression
+from .features import object_features
+from .flow_cache import flow_cache
+from .images import label_pyramid
+from .jobs import report
+from .mapping import map_spots, map_spots_streaming
+from .model_registry import get_model
+from .result_cache import result_cache, result_key
+from .tiling import (
+    N_WORKERS,
+    TILE_SIZE,
+    map_tiles,
+    read_tile,
+    segment_tiled,
+    stitch_tiles,
+    tile_grid)
+
+from typing import List, Tuple
 
 #Import only for type hinting
 from typing import TYPE_CHECKING
@@ -11,36 +28,122 @@ if TYPE_CHECKING:
     from .dataset import Dataset
 
 MAX_OBJECTS_SIZE = 3000 # max size of objects image when downsampeling
+MASK_NITER = 200 # iterations of the flow dynamics when reconstructing masks
+
+
+def cellpose_masks(
+    image: np.ndarray,
+    model_type: str,
+    flow_threshold: float,
+    cellprob_threshold: float,
+    **kwargs
+) -> np.ndarray:
+    """segment an image with a Cellpose model and return the masks.
+    Module level so it can be sent to worker processes, where the model
+    is loaded once per process and reused for every tile. Masks are
+    reconstructed exactly as from cached flows"""
+    flows = cellpose_flows(image, model_type, **kwargs)
+    return masks_from_flows(flows, flow_threshold, cellprob_threshold)
+
+
+def cellpose_flows(image: np.ndarray, model_type: str, **kwargs) -> dict:
+    """run the Cellpose network on an image without computing masks.
+    returns the flows (dP), cell probability and shape of the image"""
+    model = get_model(model_type)
+    masks, flows, styles = model.cp.eval(image, compute_masks=False, **kwargs)
+    return dict(dP=flows[1], cellprob=flows[2], shape=image.shape[:2])
+
+
+def masks_from_flows(flows: dict, flow_threshold: float, cellprob_threshold: float) -> np.ndarray:
+    """reconstruct masks from Cellpose flows, this is the only step
+    depending on the flow and mask thresholds"""
+    from cellpose import dynamics
+
+    masks, p = dynamics.compute_masks(
+        flows["dP"],
+        flows["cellprob"],
+        niter=MASK_NITER,
+        flow_threshold=flow_threshold,
+        cellprob_threshold=cellprob_threshold,
+        resize=flows["shape"]
+    )
+    return masks
+
 
 class Segmentation:
     _id = 0
+    tile_size: int = TILE_SIZE # side of tiles used by run_tiled
+    n_workers: int = N_WORKERS # processes used by run_tiled
 
     def __init__(self, dataset: "Dataset", type: str, settings: dict = dict(), objects: np.ndarray = None):
         self.set_id()
+        self.set_attributes(dataset, type, settings, objects)
+
+        # Progress is reported to the job running the segmentation, if any.
+        # Results of earlier runs on the same images and settings are reused,
+        # hashing the images reports progress and can be cancelled
+        report("hashing images")
+        key = self.cache_key()
+        cached = result_cache.get(key) if key is not None else None
+
+        report("segmenting")
+        if cached is None:
+            self.run()
+        else:
+            self.objects = cached["objects"]
+
+        if isinstance(self.dataset.gene_expression, pd.DataFrame):
+            report("mapping genes")
+            self.map_genes()
+        elif self.dataset.transcript_file is not None:
+            report("mapping genes")
+            self.map_genes_streaming()
+
+        report("calculating object features")
+        if cached is not None and cached["feature_images"] == self.feature_images():
+            self.object_features = cached["object_features"]
+            self.object_coverage = cached["object_coverage"]
+        else:
+            self.calculate_object_features()
+            if key is not None:
+                result_cache.put(
+                    key,
+                    self.objects,
+                    self.object_features,
+                    self.object_coverage,
+                    feature_images=self.feature_images()
+                )
+
+        report("downsampling")
+        self.downsample()
+
+        self.dataset.add_segmentation(self)
+
+    @classmethod
+    def restore(cls, dataset: "Dataset", id: int, type: str, settings: dict, objects: np.ndarray) -> "Segmentation":
+        """Create a segmentation from saved objects without running it.
+        Results such as gene_expression are set by the caller"""
+        seg = cls.__new__(cls)
+        seg.id = id
+        Segmentation._id = max(Segmentation._id, id + 1)
+        seg.set_attributes(dataset, type, settings, objects)
+        return seg
+
+    def set_attributes(self, dataset: "Dataset", type: str, settings: dict, objects: np.ndarray):
         self.dataset = dataset
         self.objects = objects
         self.type = type
         self.settings = settings
-        self.gene_expression: pd.DataFrame = None
+        self.gene_expression: GeneExpression = None
         self.background: pd.Series = None
+        self.object_mapping_path: str = None # per spot object ids, when streaming
         self.pct_mapped_genes: pd.Series = None
         self.object_coverage: float = None
+        self.object_features: pd.DataFrame = None
         self.cell_types: pd.DataFrame = None
+        self.pyramid: List[np.ndarray] = None # multiscale objects, level i is downsampled 2**i
         self.downsampled: Tuple[np.ndarray, float] = None # used for gene visualization of large images
 
-        self.run()
-
-        if isinstance(self.dataset.gene_expression, pd.DataFrame):
-            self.map_genes()
-
-        self.calculate_object_coverage()
-        
-        self.calculate_object_features()
-
-        self.downsample()
-
-        self.dataset.add_segmentation(self)
-
     def set_id(self):
         """Run to set next available ID of segmentation"""
         # Set unique ID
@@ -54,50 +157,90 @@ class Segmentation:
         """Algorithm used to find objects"""
         pass
 
-    def calculate_object_coverage(self):
-        """Calculate percent of image covered in objects"""
-        object_pixels = sum(sum(self.objects > 0))
-        self.object_coverage = object_pixels / (object_pixels + self.objects.size)
+    def cache_key(self) -> str:
+        """returns the key of this segmentation in result_cache,
+        or None if results are not cached"""
+        return None
+
+    def feature_images(self) -> dict:
+        """returns digests of the images object features are calculated from,
+        channels of another shape than the objects are not used"""
+        return {
+            name: self.dataset.image_digest(name)
+            for name, image in self.dataset.images.items()
+            if image.shape == self.objects.shape
+        }
+
+    def run_tiled(self, channels: list, segment_tile, overlap: int) -> np.ndarray:
+        """Segment channels in overlapping tiles using a process pool
+        and return the stitched objects.
+
+        segment_tile: picklable function returning masks of a tile
+        overlap: pixels shared between tiles, should exceed the object size"""
+        return segment_tiled(
+            channels,
+            segment_tile,
+            tile_size=self.tile_size,
+            overlap=overlap,
+            n_workers=self.n_workers,
+            progress=self.report_progress
+        )
+
+    def report_progress(self, done: int, total: int):
+        """report progress of the segmentation per tile"""
+        report("segmenting", done, total)
 
     def calculate_object_features(self):
-        features: pd.DataFrame = pd.DataFrame(measure.regionprops_table(
-            self.objects,
-            properties=[
-                "label",
-                "centroid",
-                "area",
-                "equivalent_diameter_area"]
-        ))
-        self.object_features = features
+        """Calculate label, centroid, area, equivalent diameter and bounding box
+        of each object, mean, max and integrated intensity of every channel
+        in dataset.images, and the fraction of the image covered in objects,
+        in one chunked pass over the objects"""
+        self.object_features, self.object_coverage = object_features(
+            self.objects, images=self.dataset.images, n_workers=self.n_workers
+        )
    
     def map_genes(self):
         """map genes to segmented objects.
         self.gene_expression: number of genes mapped to each cell
         self.background: number of genes mapped to backgound
         self.pct_mapped_genes: percent of induvidual genes mapped to cells"""
-        gene_map = list()
-        object_list = list()
-        for i, gene in self.dataset.gene_expression.iterrows():
-            object_id = self.objects[int(gene.y), int(gene.x)]
-            gene_map.append((gene.gene, object_id, 1))
-            object_list.append(object_id)
-            
+        object_ids, counts, genes = map_spots(self.objects, self.dataset.gene_expression)
+
         #Update segmentation gene enxression with mapped object
-        self.dataset.gene_expression["object_id"] = object_list
+        self.dataset.gene_expression["object_id"] = object_ids
+
+        self.store_counts(counts, genes)
 
-        # Create a pivot table to sum up all counts per gene and onject
-        df = pd.DataFrame(gene_map, columns=["gene", "object_id", "value"])
-        df = df.pivot_table(
-            index="object_id", columns="gene", values="value", fill_value=0, aggfunc=sum
+    def map_genes_streaming(self):
+        """map genes of dataset.transcript_file to segmented objects, one chunk
+        at a time. The object id of each spot is written to a Parquet file
+        next to the transcript file (self.object_mapping_path)"""
+        transcripts = self.dataset.transcript_file
+        self.object_mapping_path = transcripts.mapping_path(f"segmentation_{self.id}")
+
+        counts, genes = map_spots_streaming(
+            self.objects, transcripts.chunks(), output_path=self.object_mapping_path
         )
+        self.store_counts(counts, genes)
+
+    def store_counts(self, counts, genes: pd.Index):
+        """store an object x gene count matrix where row index is object id"""
+        # Keep only objects with at least one mapped spot (row 0 is background)
+        objects = counts[1:]
+        mapped = np.flatnonzero(objects.getnnz(axis=1))
 
         # Store genes mapping to objects
-        self.gene_expression = df.iloc[1:]
+        self.gene_expression = GeneExpression(
+            objects[mapped],
+            index=mapped + 1,
+            columns=genes
+        )
         # Store genes mapping to background
-        self.background = df.iloc[0]
+        self.background = pd.Series(counts[0].toarray().ravel(), index=genes)
 
         # Calculate percent of genes mapped to cells
-        self.pct_mapped_genes = self.gene_expression.sum() / (self.gene_expression.sum() + self.background)
+        mapped_totals = self.gene_expression.gene_totals()
+        self.pct_mapped_genes = mapped_totals / (mapped_totals + self.background)
 
         # broadcast that genes are mapped
         self.dataset.com.genes_mapped.emit()
@@ -107,18 +250,90 @@ class Segmentation:
         self.dataset.com.cell_types_changed.emit()
 
     def downsample(self):
-        objects = self.objects.copy()
-        scale = 1.0
-        while objects.shape[0] > MAX_OBJECTS_SIZE or objects.shape[1] > MAX_OBJECTS_SIZE:
-            # half the resulotion each run
-            objects = objects[::2, ::2]
-            scale += scale
-        self.downsampled = (objects, scale)
+        """Build a multiscale pyramid of the objects that keeps small objects.
+        The first level fitting MAX_OBJECTS_SIZE is used for gene visualization"""
+        self.pyramid = label_pyramid(self.objects)
+
+        for level, objects in enumerate(self.pyramid):
+            if objects.shape[0] <= MAX_OBJECTS_SIZE and objects.shape[1] <= MAX_OBJECTS_SIZE:
+                break
+        self.downsampled = (objects, float(2 ** level))
+
 
+class segmentCellpose(Segmentation):
+    """Base class for Cellpose segmentation.
 
-class segmentNuclei(Segmentation):
+    Network outputs are cached in flow_cache, keyed by the images, their
+    crop and the diameter, so changing only the flow or mask threshold
+    recomputes the masks without running the network again.
+    """
+    model_type: str = None # Cellpose model
+    image_channels: list = [] # keys of dataset.images stacked as input
+    channels: list = None # Cellpose channels argument
+
+    def run(self):
+        images = [self.dataset.images[name] for name in self.image_channels]
+        shape = images[0].shape[:2]
+        overlap = 2 * self.size
+        tiles = tile_grid(shape, self.tile_size, overlap)
+
+        # Flows are at most 3 float32 values per pixel
+        if not flow_cache.fits(shape[0] * shape[1] * 12):
+            self.objects = self.run_tiled(images, self.segment_tile(), overlap)
+            return
+
+        key = (
+            tuple(self.dataset.image_key(name) for name in self.image_channels),
+            self.model_type,
+            self.size,
+            self.tile_size,
+        )
+        flows = flow_cache.get(key)
+        if flows is None:
+            network = partial(
+                cellpose_flows,
+                model_type=self.model_type,
+                channels=self.channels,
+                diameter=self.size,
+                resample=False
+            )
+            tile_images = (read_tile(images, tile) for tile in tiles)
+            flows = list(map_tiles(network, tile_images, len(tiles), self.n_workers, self.report_progress))
+            flow_cache.put(key, flows)
+
+        reconstruct = partial(
+            masks_from_flows,
+            flow_threshold=self.flow_threshold,
+            cellprob_threshold=self.mask_threshold
+        )
+        # Reconstructed in threads, so cached flows are not sent to the worker processes
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            self.objects = stitch_tiles(shape, tiles, pool.map(reconstruct, flows))
+
+    def cache_key(self) -> str:
+        """Key from the pixels of the input images, the type and settings.
+        Tile size is included as it changes how objects are stitched"""
+        digests = [self.dataset.image_digest(name) for name in self.image_channels]
+        return result_key(self.type, self.settings, digests, tile_size=self.tile_size)
+
+    def segment_tile(self):
+        """returns a picklable function segmenting one tile"""
+        return partial(
+            cellpose_masks,
+            model_type=self.model_type,
+            channels=self.channels,
+            diameter=self.size,
+            flow_threshold=self.flow_threshold,
+            cellprob_threshold=self.mask_threshold,
+            resample=False
+        )
+
+
+class segmentNuclei(segmentCellpose):
     """Segment an image base on nuclei signal
     Stores segmentation under self.objects"""
+    model_type = "nuclei"
+    image_channels = ["Nuclei"]
 
     def __init__(self, dataset, size=70, flow_threshold=0.4, mask_threshold=0):
         # set attributes
@@ -129,25 +344,16 @@ class segmentNuclei(Segmentation):
         self.flow_threshold = flow_threshold
         self.mask_threshold = mask_threshold
 
-        super().__init__(dataset=dataset, type="Cellpose - Nuclei")
-        
-
-    def run(self):
-        model = models.Cellpose(model_type="nuclei")
-        masks, flows, styles, diams = model.eval(
-            self.dataset.images["Nuclei"],
-            diameter=self.size,
-            flow_threshold=self.flow_threshold,
-            cellprob_threshold=self.mask_threshold,
-            resample=False
-        )
-
-        self.objects = masks
+        super().__init__(dataset=dataset, type="Cellpose - Nuclei", settings=self.settings)
 
 
-class segmentCytoplasm(Segmentation):
+class segmentCytoplasm(segmentCellpose):
     """Segment an image base on nuclei and cytoplasm signal
     Stores segmentation under self.objects"""
+    model_type = "cyto"
+    # Nuclei and cytoplasm are stacked into a channel image per tile
+    image_channels = ["Nuclei", "Cytoplasm"]
+    channels = [2, 1]
 
     def __init__(self, dataset, size=120, flow_threshold=0.4, mask_threshold=0):
         # set attributes
@@ -158,26 +364,4 @@ class segmentCytoplasm(Segmentation):
         self.flow_threshold = flow_threshold
         self.mask_threshold = mask_threshold
 
-        super().__init__(dataset=dataset, type="Cellpose - Cytoplasm")
-        
-
-    def run(self):
-        """segment image using nuclei information"""
-        import numpy as np
-
-        n = self.dataset.images["Nuclei"]
-        c = self.dataset.images["Cytoplasm"]
-
-        # Stack nuclei and cytoplasm images into a channel image
-        arr = np.dstack((n, c))
-        model = models.Cellpose(model_type="cyto")
-        masks, flows, styles, diams = model.eval(
-            x=arr,
-            channels=[2, 1],
-            diameter=self.size,
-            flow_threshold=self.flow_threshold,
-            cellprob_threshold=self.mask_threshold,
-            resample=False
-        )
-
-        self.objects = masks
\ No newline at end of file
+        super().__init__(dataset=dataset, type="Cellpose - Cytoplasm", settings=self.settings)
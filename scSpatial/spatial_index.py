@@ -0,0 +1,66 @@
+import numpy as np
+
+TILE_SIZE = 256 # side length in pixels of the tiles used to bucket spots
+
+
+class SpatialIndex:
+    """Grid bucketed index of spot positions answering bounding box queries.
+
+    Spots are sorted by the tile they fall in, so all spots of a row of
+    tiles are stored contiguously and a query only visits the tiles
+    overlapping the bounding box.
+
+    row, col: position of each spot along image axis 0 and 1
+    """
+
+    def __init__(self, row: np.ndarray, col: np.ndarray, tile_size: int = TILE_SIZE):
+        self.tile_size = tile_size
+
+        row = np.asarray(row)
+        col = np.asarray(col)
+        tile_row = self._tile(row)
+        tile_col = self._tile(col)
+        self.n_tile_rows = int(tile_row.max()) + 1 if len(row) > 0 else 1
+        self.n_tile_cols = int(tile_col.max()) + 1 if len(col) > 0 else 1
+
+        # Sort spots by tile and store where each tile starts
+        tile_id = tile_row * self.n_tile_cols + tile_col
+        self.order = np.argsort(tile_id, kind="stable")
+        counts = np.bincount(tile_id, minlength=self.n_tile_rows * self.n_tile_cols)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        # Coordinates in tile order, for exact filtering of candidates
+        self.row = row[self.order]
+        self.col = col[self.order]
+
+    def __len__(self):
+        return len(self.order)
+
+    def _tile(self, position) -> np.ndarray:
+        return np.clip(np.floor_divide(position, self.tile_size), 0, None).astype(np.int64)
+
+    def query(self, row0: float, row1: float, col0: float, col1: float) -> np.ndarray:
+        """returns sorted positions of spots with row0 <= row < row1 and col0 <= col < col1"""
+        if len(self) == 0 or row1 <= row0 or col1 <= col0:
+            return np.empty(0, dtype=np.int64)
+
+        # Tiles overlapping the bounding box
+        t_row0, t_row1 = self._tile(np.array([row0, row1]))
+        t_col0, t_col1 = self._tile(np.array([col0, col1]))
+        t_row1 = min(t_row1, self.n_tile_rows - 1)
+        t_col1 = min(t_col1, self.n_tile_cols - 1)
+        if t_row0 > t_row1 or t_col0 > t_col1:
+            return np.empty(0, dtype=np.int64)
+
+        hits = list()
+        for t_row in range(t_row0, t_row1 + 1):
+            # Tiles in one row are contiguous in the sorted order
+            start = self.offsets[t_row * self.n_tile_cols + t_col0]
+            stop = self.offsets[t_row * self.n_tile_cols + t_col1 + 1]
+
+            row = self.row[start:stop]
+            col = self.col[start:stop]
+            inside = (row >= row0) & (row < row1) & (col >= col0) & (col < col1)
+            hits.append(self.order[start:stop][inside])
+
+        return np.sort(np.concatenate(hits))
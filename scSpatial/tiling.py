@@ -0,0 +1,199 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import numpy as np
+
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+TILE_SIZE = 2048 # side of the tiles segmented by each worker
+N_WORKERS = max(1, (os.cpu_count() or 1) // 4) # processes used for tiled segmentation
+
+# Worker processes are kept alive between runs so models loaded in them are reused
+_pool: ProcessPoolExecutor = None
+_pool_size: int = 0
+
+
+def tile_grid(shape: Tuple[int, int], tile_size: int, overlap: int) -> List[Tuple[int, int, int, int]]:
+    """returns (r0, r1, c0, c1) of overlapping tiles covering an image of shape"""
+    step = max(1, tile_size - overlap)
+    tiles = list()
+    for r0 in _starts(shape[0], tile_size, step):
+        for c0 in _starts(shape[1], tile_size, step):
+            tiles.append((r0, min(r0 + tile_size, shape[0]), c0, min(c0 + tile_size, shape[1])))
+    return tiles
+
+
+def _starts(length: int, tile_size: int, step: int) -> List[int]:
+    """start positions along one axis, the last tile ends at the image border"""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, step))
+    starts.append(length - tile_size)
+    return starts
+
+
+def read_tile(channels: List, tile: Tuple[int, int, int, int]) -> np.ndarray:
+    """reads a tile from each channel, stacked along the last axis if more than one"""
+    r0, r1, c0, c1 = tile
+    arrays = [np.asarray(channel[r0:r1, c0:c1]) for channel in channels]
+    return arrays[0] if len(arrays) == 1 else np.dstack(arrays)
+
+
+def stitch_tile(
+    labels: np.ndarray,
+    masks: np.ndarray,
+    tile: Tuple[int, int, int, int],
+    next_label: int
+) -> int:
+    """Adds the masks of one tile to the stitched label image.
+
+    Objects touching an edge of the tile that is not the image border are
+    incomplete and dropped, the neighbouring tile holds them in full when
+    the overlap is larger than the objects. Objects mostly covered by
+    already stitched objects are duplicates from a neighbouring tile and
+    are dropped too. Returns the next free label.
+    """
+    r0, r1, c0, c1 = tile
+    region = labels[r0:r1, c0:c1]
+    masks = masks.astype(np.int64)
+    n = int(masks.max()) + 1
+
+    # Objects cut by an inner tile edge
+    edges = list()
+    if r0 > 0:
+        edges.append(masks[0, :])
+    if r1 < labels.shape[0]:
+        edges.append(masks[-1, :])
+    if c0 > 0:
+        edges.append(masks[:, 0])
+    if c1 < labels.shape[1]:
+        edges.append(masks[:, -1])
+    cut = np.zeros(n, dtype=bool)
+    for edge in edges:
+        cut[edge] = True
+
+    # Objects already stitched from a neighbouring tile
+    area = np.bincount(masks.ravel(), minlength=n)
+    covered = np.bincount(masks[region > 0], minlength=n)
+
+    keep = (area > 0) & ~cut & (covered <= area / 2)
+    keep[0] = False
+
+    # Relabel kept objects with one lookup over the tile
+    lut = np.zeros(n, dtype=labels.dtype)
+    lut[keep] = np.arange(next_label, next_label + keep.sum())
+    relabeled = lut[masks]
+    free = (relabeled > 0) & (region == 0)
+    region[free] = relabeled[free]
+
+    return next_label + int(keep.sum())
+
+
+def segment_tiled(
+    channels: List,
+    segment_tile: Callable[[np.ndarray], np.ndarray],
+    tile_size: int = TILE_SIZE,
+    overlap: int = 256,
+    n_workers: int = N_WORKERS,
+    progress: Callable[[int, int], None] = None
+) -> np.ndarray:
+    """Segments an image tile by tile and stitches the tiles into one label image.
+
+    channels: 2D array-like images of equal shape, stacked per tile
+    segment_tile: picklable function returning the masks of a tile
+    overlap: pixels shared by neighbouring tiles, should exceed the object diameter
+    progress: called with (finished tiles, total tiles) after each tile
+    """
+    shape = channels[0].shape[:2]
+    tiles = tile_grid(shape, tile_size, overlap)
+
+    # Tiles are read as they are submitted to the workers
+    images = (read_tile(channels, tile) for tile in tiles)
+    masks = map_tiles(segment_tile, images, len(tiles), n_workers, progress)
+
+    return stitch_tiles(shape, tiles, masks)
+
+
+def stitch_tiles(shape: Tuple[int, int], tiles: List, masks: Iterable[np.ndarray]) -> np.ndarray:
+    """stitches the masks of each tile, in tile order, into one label image"""
+    labels = np.zeros(shape, dtype=np.int32)
+    next_label = 1
+    for tile, tile_masks in zip(tiles, masks):
+        next_label = stitch_tile(labels, tile_masks, tile, next_label)
+    return labels
+
+
+def map_tiles(
+    function: Callable,
+    inputs: Iterable,
+    n_tiles: int,
+    n_workers: int = N_WORKERS,
+    progress: Callable[[int, int], None] = None
+) -> Iterator:
+    """Yields function(input) for each tile input, in order.
+
+    Runs in the shared process pool if there is more than one tile and
+    reports (finished tiles, total tiles) to progress after each tile."""
+    for i, result in enumerate(_run_tiles(function, inputs, n_tiles, n_workers)):
+        logging.info(f"processed tile {i + 1}/{n_tiles}")
+        if progress is not None:
+            progress(i + 1, n_tiles)
+        yield result
+
+
+def _run_tiles(function, inputs, n_tiles, n_workers) -> Iterator:
+    if n_tiles == 1 or n_workers <= 1:
+        for tile_input in inputs:
+            yield function(tile_input)
+        return
+
+    pool = get_pool(n_workers)
+    try:
+        # Bound the tiles in flight so only a few tiles are held in memory
+        pending = deque()
+        for tile_input in inputs:
+            pending.append(pool.submit(function, tile_input))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        shutdown_pool()
+        raise
+
+
+def get_pool(n_workers: int) -> ProcessPoolExecutor:
+    """returns the shared process pool, created with n_workers on first use"""
+    global _pool, _pool_size
+    if _pool is None or _pool_size != n_workers:
+        shutdown_pool()
+        threads = max(1, (os.cpu_count() or 1) // n_workers)
+        # Spawned, not forked, as CUDA, torch thread pools and Qt threads of
+        # the parent (models are loaded there by warm_up) are not fork safe
+        _pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(threads,)
+        )
+        _pool_size = n_workers
+    return _pool
+
+
+def shutdown_pool():
+    """stops the shared process pool and the models loaded in it"""
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+    _pool = None
+    _pool_size = 0
+
+
+def _init_worker(threads: int):
+    """limit threads per worker so workers do not oversubscribe the cores"""
+    import torch
+
+    torch.set_num_threads(threads)
@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import pandas as pd
+
+from typing import Iterator, List
+
+CHUNK_SIZE = 5_000_000 # rows read per chunk when streaming transcripts
+PARQUET_SUFFIXES = (".parquet", ".pq")
+ARROW_SUFFIXES = (".feather", ".arrow", ".ipc")
+
+
+def file_format(path: str) -> str:
+    """returns "parquet", "arrow" or "csv" based on the file suffix"""
+    name = str(path).lower()
+    if name.endswith(PARQUET_SUFFIXES):
+        return "parquet"
+    if name.endswith(ARROW_SUFFIXES):
+        return "arrow"
+    return "csv"
+
+
+def read_columns(path: str) -> List[str]:
+    """returns the column names of a transcript file, reading only its header or schema"""
+    fmt = file_format(path)
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.read_schema(path).names
+
+    if fmt == "arrow":
+        from pyarrow import ipc
+
+        # Feather v2 files are Arrow IPC files
+        return ipc.open_file(path).schema.names
+
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def read_transcripts(path: str, x: str, y: str, gene: str) -> pd.DataFrame:
+    """Reads only the x, y and gene columns of a transcript file.
+
+    Returns a DataFrame with columns x and y as float32 and gene as category."""
+    fmt = file_format(path)
+    columns = [x, y, gene]
+
+    if fmt == "parquet":
+        df = pd.read_parquet(path, columns=columns)
+    elif fmt == "arrow":
+        df = pd.read_feather(path, columns=columns)
+    else:
+        df = pd.read_csv(
+            path,
+            usecols=columns,
+            dtype={x: np.float32, y: np.float32, gene: "category"}
+        )
+
+    return standardize(df, x, y, gene)
+
+
+def standardize(df: pd.DataFrame, x: str, y: str, gene: str) -> pd.DataFrame:
+    """renames columns to x, y and gene and sets compact dtypes"""
+    return pd.DataFrame({
+        "x": df[x].to_numpy(dtype=np.float32),
+        "y": df[y].to_numpy(dtype=np.float32),
+        "gene": df[gene].astype("category"),
+    })
+
+
+def iter_transcripts(path: str, x: str, y: str, gene: str, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Reads the x, y and gene columns of a transcript file in chunks of chunk_size rows.
+
+    Yields DataFrames with columns x, y and gene as in read_transcripts."""
+    fmt = file_format(path)
+    columns = [x, y, gene]
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield standardize(batch.to_pandas(), x, y, gene)
+
+    elif fmt == "arrow":
+        from pyarrow import ipc
+
+        reader = ipc.open_file(path)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i).select(columns)
+            yield standardize(batch.to_pandas(), x, y, gene)
+
+    else:
+        chunks = pd.read_csv(
+            path,
+            usecols=columns,
+            dtype={x: np.float32, y: np.float32, gene: "category"},
+            chunksize=chunk_size
+        )
+        for chunk in chunks:
+            yield standardize(chunk, x, y, gene)
+
+
+class TranscriptFile:
+    """Transcript file that is read in chunks instead of loaded into memory.
+    Used to map genes of files larger than RAM.
+
+    x, y, gene: columns of the file holding position and gene name"""
+
+    def __init__(self, path: str, x: str, y: str, gene: str, chunk_size: int = CHUNK_SIZE):
+        self.path = path
+        self.x = x
+        self.y = y
+        self.gene = gene
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return f"TranscriptFile: {self.path}"
+
+    def chunks(self) -> Iterator[pd.DataFrame]:
+        """yields chunks with columns x, y and gene"""
+        return iter_transcripts(self.path, self.x, self.y, self.gene, self.chunk_size)
+
+    def mapping_path(self, name: str) -> str:
+        """returns the path of the per spot object id file written next to the transcript file"""
+        stem = os.path.splitext(self.path)[0]
+        return f"{stem}.{name}.parquet"
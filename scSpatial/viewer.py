@@ -1,8 +1,8 @@
 
 import napari
-import numpy as np
 
 from .dataset import Dataset
+from .images import contrast_limits
 from .segmentation import Segmentation
 
 
@@ -11,9 +11,11 @@ class Viewer(napari.Viewer):
     """
 
     def add_segmentation(self, seg: Segmentation, dataset: Dataset):
-        """Add segmentation to viewer"""
+        """Add segmentation to viewer, as a multiscale layer for large segmentations"""
+        multiscale = len(seg.pyramid) > 1
         self.add_labels(
-            seg.objects,
+            seg.pyramid if multiscale else seg.objects,
+            multiscale=multiscale,
             translate=dataset.translate,
             name=seg.__repr__()
         )
@@ -25,32 +27,12 @@ class Viewer(napari.Viewer):
     def add_nuclei(self, dataset: Dataset):
         """Add image with key "Nuclei" to viewer"""
 
-        image = dataset.images["Nuclei"]
-        min_v = np.min(image)
-        max_v = np.max(image)
-
-        self.add_image(
-            image,
-            name="Nuclei",
-            colormap="yellow",
-            blending="additive",
-            contrast_limits=(min_v, max_v)
-        )
+        self.add_pyramid(dataset, channel="Nuclei", colormap="yellow")
 
     def add_cytoplasm(self, dataset: Dataset):
         """Add image with key "Cytoplasm" to viewer"""
 
-        image = dataset.images["Cytoplasm"]
-        min_v = np.min(image)
-        max_v = np.max(image)
-
-        self.add_image(
-            image,
-            name="Cytoplasm",
-            colormap="cyan",
-            blending="additive",
-            contrast_limits=(min_v, max_v)
-        )
+        self.add_pyramid(dataset, channel="Cytoplasm", colormap="cyan")
 
     def add_other_channel(
         self,
@@ -59,11 +41,30 @@ class Viewer(napari.Viewer):
         colormap: str = "magenta"
     ):
         """Add image with given channel to viewer"""
+        self.add_pyramid(dataset, channel=channel, colormap=colormap)
+
+    def add_channel(self, dataset: Dataset, channel: str):
+        """Add image of channel to viewer, with the colormap of its kind"""
+        if channel == "Nuclei":
+            self.add_nuclei(dataset)
+        elif channel == "Cytoplasm":
+            self.add_cytoplasm(dataset)
+        else:
+            self.add_other_channel(dataset, channel=channel)
+
+    def add_pyramid(self, dataset: Dataset, channel: str, colormap: str):
+        """Add image pyramid of channel as a multiscale layer.
+        Contrast limits are estimated from the coarsest level"""
+        pyramid = dataset.get_pyramid(channel)
+        multiscale = len(pyramid) > 1
+
         self.add_image(
-            dataset.images[channel],
+            pyramid if multiscale else pyramid[0],
+            multiscale=multiscale,
             name=channel,
             colormap=colormap,
-            blending="additive"
+            blending="additive",
+            contrast_limits=contrast_limits(pyramid[-1])
         )
 
     def add_genes(self, dataset: Dataset):
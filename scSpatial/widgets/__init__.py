@@ -2,4 +2,5 @@ from . import loaddata
 from . import segmentation
 from . import analysis
 from . import visualization
+from . import jobs
 from . import main_widget
@@ -5,7 +5,9 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QFont, QColor
 from PyQt5.QtWidgets import (
     QApplication,
+    QCheckBox,
     QComboBox,
+    QDoubleSpinBox,
     QFileDialog,
     QFormLayout,
     QGridLayout,
@@ -14,6 +16,7 @@ from PyQt5.QtWidgets import (
     QListWidget,
     QPushButton,
     QSlider,
+    QSpinBox,
     QVBoxLayout,
     QWidget,
     QTableWidget,
@@ -24,7 +27,8 @@ import sys
 
 from ..dataset import Dataset
 from ..viewer import Viewer
-from ..analysis import Bonefight
+from ..analysis import EPOCHS, LEARNING_RATE, Bonefight, ScoreTransfer, read_reference
+from ..jobs import Job, get_scheduler
 
 class analysisWidget(QWidget):
     """Widget used to run different analysis methods.
@@ -48,7 +52,44 @@ class analysisWidget(QWidget):
 
         self.obs_example_list = QListWidget(self)
 
-        self.bonefight_btn = QPushButton("Run BoneFight analysis")
+        # BoneFight, or a fast vectorized score of cells against the group means
+        self.method_combo = QComboBox(self)
+        self.method_combo.addItems(["BoneFight", "Correlation", "NNLS"])
+        self.method_combo.currentTextChanged.connect(self.method_changed)
+
+        # Settings of the BoneFight fit
+        self.epochs_spin = QSpinBox(self)
+        self.epochs_spin.setRange(1, 10000)
+        self.epochs_spin.setValue(EPOCHS)
+
+        self.learning_rate_spin = QDoubleSpinBox(self)
+        self.learning_rate_spin.setDecimals(3)
+        self.learning_rate_spin.setRange(0.001, 10)
+        self.learning_rate_spin.setSingleStep(0.01)
+        self.learning_rate_spin.setValue(LEARNING_RATE)
+
+        self.early_stopping_chk = QCheckBox("Stop early when converged", self)
+        self.early_stopping_chk.setToolTip(
+            "Fit a quarter of the epochs first and stop if the loss no longer changes. "
+            "Otherwise the model is fit again for all epochs, which takes up to 1.25 times as long as without early stopping"
+        )
+
+        self.batch_size_spin = QSpinBox(self)
+        self.batch_size_spin.setRange(0, 10_000_000)
+        self.batch_size_spin.setSingleStep(10_000)
+        self.batch_size_spin.setSpecialValueText("All")
+        self.batch_size_spin.setToolTip("Transfer labels to this many cells at a time, limits memory on large segmentations")
+
+        fit_layout = QFormLayout()
+        fit_layout.addRow("Epochs", self.epochs_spin)
+        fit_layout.addRow("Learning rate", self.learning_rate_spin)
+        fit_layout.addRow("Cells per batch", self.batch_size_spin)
+        fit_layout.addRow(self.early_stopping_chk)
+
+        self.fit_widget = QWidget(self)
+        self.fit_widget.setLayout(fit_layout)
+
+        self.bonefight_btn = QPushButton("Run label transfer")
         self.bonefight_btn.clicked.connect(self.run_bonefight_analysis)
         self.bonefight_btn.setEnabled(False)
 
@@ -56,18 +97,22 @@ class analysisWidget(QWidget):
         self.layout.addWidget(QLabel("Select observation key:"))
         self.layout.addWidget(self.groupby_combo)
         self.layout.addWidget(self.obs_example_list)
-        self.layout.addWidget(QLabel("BoneFight analysis"))
+        self.layout.addWidget(QLabel("Label transfer method:"))
+        self.layout.addWidget(self.method_combo)
+        self.layout.addWidget(self.fit_widget)
         self.layout.addWidget(self.bonefight_btn)
         self.layout.addStretch()
         self.setLayout(self.layout)
 
     def read_reference_dataset(self):
-        import scanpy as sc
-
         path = QFileDialog.getOpenFileName(self, caption="Select reference dataset")[0]
+        if not path:
+            return
 
-        self.reference_adata = sc.read(path)
+        self.reference_path = path
+        self.reference_adata = read_reference(path)
 
+        self.groupby_combo.clear()
         if len(self.reference_adata.obs_keys()) > 0:
             self.groupby_combo.addItems(self.reference_adata.obs_keys())
         else:
@@ -77,17 +122,49 @@ class analysisWidget(QWidget):
         from random import sample
 
         self.obs_example_list.clear()
-        example_list = sample(list(set(self.reference_adata.obs[key])), k=10)
+        if not key:
+            return
+
+        # Categorical columns list their groups without scanning the cells
+        column = self.reference_adata.obs[key]
+        groups = column.cat.categories if hasattr(column, "cat") else pd.unique(column)
+        example_list = sample(list(groups), k=min(10, len(groups)))
         self.obs_example_list.addItems([str(example) for example in example_list])
         self.bonefight_btn.setEnabled(True)
 
+    def method_changed(self, method: str):
+        """Fit settings only apply to BoneFight"""
+        self.fit_widget.setVisible(method == "BoneFight")
+
     def run_bonefight_analysis(self):
+        segmentation = self.dataset.active_segmentation
+        method = self.method_combo.currentText()
+        if method != "BoneFight":
+            model = ScoreTransfer(
+                segmentation=segmentation,
+                reference=self.reference_adata,
+                groupby=self.groupby_combo.currentText(),
+                reference_path=self.reference_path,
+                method=method.lower(),
+            )
+            job = Job(f"{method} transfer", model.transfer_labels)
+            job.returned.connect(segmentation.add_cell_types)
+            get_scheduler().submit(job)
+            return
+
         # Instantiate the bonefight object
         bf_model = Bonefight(
-            segmentation=self.dataset.active_segmentation,
+            segmentation=segmentation,
             reference=self.reference_adata,
             groupby=self.groupby_combo.currentText(),
+            reference_path=self.reference_path,
+            epochs=self.epochs_spin.value(),
+            learning_rate=self.learning_rate_spin.value(),
+            early_stopping=self.early_stopping_chk.isChecked(),
+            batch_size=self.batch_size_spin.value() or None,
         )
 
-        cell_types = bf_model.transfer_labels()
-        self.dataset.active_segmentation.add_cell_types(cell_types)
+        # Transfer labels in a job and add the result to the segmentation it ran on
+        job = Job("BoneFight", bf_model.transfer_labels)
+        job.returned.connect(segmentation.add_cell_types)
+        get_scheduler().submit(job)
@@ -0,0 +1,59 @@
+from PyQt5.QtWidgets import (
+    QHBoxLayout,
+    QLabel,
+    QProgressBar,
+    QPushButton,
+    QWidget)
+
+from ..jobs import Job, JobScheduler
+
+
+class jobWidget(QWidget):
+    """Shows progress of the running job and allows cancelling it"""
+
+    def __init__(self, scheduler: JobScheduler):
+        super().__init__()
+        self.scheduler = scheduler
+        self.initUI()
+
+    def initUI(self):
+        layout = QHBoxLayout(self)
+
+        self.lbl_stage = QLabel("")
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(0)
+
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.setToolTip("Cancel the running job and all queued jobs")
+        self.cancel_btn.clicked.connect(self.scheduler.cancel)
+        self.cancel_btn.setEnabled(False)
+
+        layout.addWidget(self.lbl_stage)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.cancel_btn)
+        self.setLayout(layout)
+
+        self.scheduler.job_started.connect(self.job_started)
+        self.scheduler.job_finished.connect(self.job_finished)
+
+    def job_started(self, job: Job):
+        job.progress.connect(self.update_progress)
+        self.lbl_stage.setText(job.name)
+        # Busy indicator until the job reports a total
+        self.progress_bar.setRange(0, 0)
+        self.cancel_btn.setEnabled(True)
+
+    def update_progress(self, stage: str, done: int, total: int):
+        self.lbl_stage.setText(stage)
+        if total > 0:
+            self.progress_bar.setRange(0, total)
+            self.progress_bar.setValue(done)
+        else:
+            self.progress_bar.setRange(0, 0)
+
+    def job_finished(self, job: Job):
+        self.lbl_stage.setText("")
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(0)
+        self.cancel_btn.setEnabled(False)
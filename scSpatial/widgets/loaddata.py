@@ -5,6 +5,7 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QFont, QColor
 from PyQt5.QtWidgets import (
     QApplication,
+    QCheckBox,
     QComboBox,
     QFileDialog,
     QFormLayout,
@@ -25,10 +26,28 @@ import sys
 from ..dataset import Dataset
 from ..viewer import Viewer
 from ..analysis import Bonefight
+from ..jobs import Job, get_scheduler, report
+from ..project import load_project, save_project
+from ..transcripts import TranscriptFile, read_columns, read_transcripts
 
 h1 = QFont("Arial", 13)
 
 
+def build_pyramids(dataset: Dataset, channels: list) -> list:
+    """builds the image pyramid of each channel, returns the channels"""
+    for channel in channels:
+        report(f"opening {channel}")
+        dataset.get_pyramid(channel)
+    return channels
+
+
+def read_project(path: str, dataset: Dataset) -> list:
+    """loads a project into dataset and builds the pyramids of its images,
+    returns the channels"""
+    load_project(path, dataset)
+    return build_pyramids(dataset, list(dataset.images))
+
+
 class loadWidget(QWidget):
     """Widget holding all widgets used for loading data"""
 
@@ -40,11 +59,66 @@ class loadWidget(QWidget):
 
     def initUI(self):
         layout = QVBoxLayout(self)
+        layout.addWidget(projectWidget(self.dataset, self.viewer))
         layout.addWidget(loadImageWidget(self.dataset, self.viewer))
         layout.addWidget(loadGenesWidget(self.dataset, self.viewer))
         self.setLayout(layout)
 
 
+class projectWidget(QWidget):
+    """Widget used for saving and opening projects"""
+
+    def __init__(self, dataset: Dataset, viewer: Viewer):
+        super().__init__()
+        self.dataset = dataset
+        self.viewer = viewer
+        self.initUI()
+
+    def initUI(self):
+        layout = QHBoxLayout()
+
+        btn_open = QPushButton("Open project")
+        btn_open.clicked.connect(self.open_project)
+        btn_open.setToolTip("Open a saved project, images and segmentations are read lazily")
+        layout.addWidget(btn_open)
+
+        btn_save = QPushButton("Save project")
+        btn_save.clicked.connect(self.save_project)
+        btn_save.setToolTip("Save images, genes and segmentations to a project folder")
+        layout.addWidget(btn_save)
+
+        self.setLayout(layout)
+
+    def save_project(self):
+        path = QFileDialog.getSaveFileName(
+            self, caption="Save project", filter="scSpatial project (*.zarr)"
+        )[0]
+        if path:
+            if not path.endswith(".zarr"):
+                path = f"{path}.zarr"
+            get_scheduler().submit(Job("Save project", save_project, self.dataset, path))
+
+    def open_project(self):
+        path = QFileDialog.getExistingDirectory(self, caption="Open project")
+        if path:
+            # Genes and pyramids are read in a job, the layers are replaced when it is done
+            self.viewer.layers.clear()
+            job = Job("Open project", read_project, path, self.dataset)
+            job.returned.connect(self.add_to_viewer)
+            get_scheduler().submit(job)
+
+    def add_to_viewer(self, channels: list):
+        """Add the images of channels, genes and segmentations of the loaded project"""
+        for channel in channels:
+            self.viewer.add_channel(self.dataset, channel)
+
+        if isinstance(self.dataset.gene_expression, pd.DataFrame):
+            self.viewer.add_genes(self.dataset)
+
+        for seg in self.dataset.segmentation.values():
+            self.viewer.add_segmentation(seg, self.dataset)
+
+
 class loadImageWidget(QWidget):
     """Widget used for loading images"""
 
@@ -96,7 +170,7 @@ class loadImageWidget(QWidget):
         if path:
             self.label_nuc.setText(file_name)
             self.dataset.load_nuclei(self.nuclei_path)
-            self.viewer.add_nuclei(self.dataset)
+            self.open_channel("Nuclei")
 
     def launchCytoplasmDialog(self):
         path = QFileDialog.getOpenFileName(self, "Select a cytoplasm image", "")[0]
@@ -106,7 +180,7 @@ class loadImageWidget(QWidget):
         if path:
             self.label_cyto.setText(file_name)
             self.dataset.load_cytoplasm(self.cytoplasm_path)
-            self.viewer.add_cytoplasm(self.dataset)
+            self.open_channel("Cytoplasm")
 
     def launchOtherDialog(self):
         # TODO Add ability to name added channel
@@ -117,7 +191,18 @@ class loadImageWidget(QWidget):
         if path:
             self.label_other.setText(fname)
             self.dataset.load_other_channel(channel="other", path=self.other_path)
-            self.viewer.add_other_channel(self.dataset, channel="other")
+            self.open_channel("other")
+
+    def open_channel(self, channel: str):
+        """Builds the image pyramid of channel in a job, large images
+        take minutes the first time. The image is added to the viewer when done"""
+        job = Job(f"Open {channel}", build_pyramids, self.dataset, [channel])
+        job.returned.connect(self.add_channels)
+        get_scheduler().submit(job)
+
+    def add_channels(self, channels: list):
+        for channel in channels:
+            self.viewer.add_channel(self.dataset, channel)
 
 class loadGenesWidget(QWidget):
     """Widget used for loading gene expression file"""
@@ -145,18 +230,17 @@ class loadGenesWidget(QWidget):
         """Runns the file dialog and add more elements to the
         UI for selecting correct columns"""
 
-        import pandas as pd
-
         # Fetch path to file, note that this return a
         # tuple and path is on index 0
         path = QFileDialog.getOpenFileName(
-            self, caption="select a gene expression file"
+            self,
+            caption="select a gene expression file",
+            filter="Gene expression files (*.csv *.parquet *.pq *.feather *.arrow *.ipc);;All files (*)"
         )
+        self.path = path[0]
 
-        # read in the gene expression file into df
-        # and also store columns in a variable
-        self.df = pd.read_csv(path[0])
-        self.columns = self.df.columns
+        # Only read the header or schema, the data is read once columns are selected
+        self.columns = read_columns(self.path)
 
         # Create the selection widgets and add the columns options
         self.list_x = QComboBox()
@@ -167,7 +251,7 @@ class loadGenesWidget(QWidget):
         self.list_gene.addItems(self.columns)
 
         # If we recognize the columns, preset the values
-        if "PosX" and "PosY" and "Gene" in self.columns:
+        if all(column in self.columns for column in ["PosX", "PosY", "Gene"]):
             self.list_x.setCurrentText("PosX")
             self.list_y.setCurrentText("PosY")
             self.list_gene.setCurrentText("Gene")
@@ -177,26 +261,31 @@ class loadGenesWidget(QWidget):
         self.layout.addRow("y", self.list_y)
         self.layout.addRow("gene", self.list_gene)
 
+        # Large files are mapped chunk by chunk instead of loaded
+        self.chk_stream = QCheckBox("Stream from file")
+        self.chk_stream.setToolTip("Map genes chunk by chunk, for files larger than memory. Genes are not shown in the viewer")
+        self.layout.addWidget(self.chk_stream)
+
         # Add a confirmation button to the bottom of the UI
         self.btn_confirm_columns = QPushButton("Confirm")
         self.btn_confirm_columns.clicked.connect(self.save_df_to_dataset)
         self.layout.addWidget(self.btn_confirm_columns)
 
     def save_df_to_dataset(self):
-        """Renames the columns of the gene expression dataframe
+        """Reads the selected columns of the gene expression file
         and stores it in the dataset. Furthermore adds these to the viewer"""
         # Find file representation of columns
         x = self.list_x.currentText()
         y = self.list_y.currentText()
         gene = self.list_gene.currentText()
 
-        # Filter on x y and gene
-        self.df = self.df[[x, y, gene]]
-        # Rename columns to standardized names
-        self.df.columns = ["x", "y", "gene"]
+        if self.chk_stream.isChecked():
+            self.dataset.add_transcript_file(TranscriptFile(self.path, x=x, y=y, gene=gene))
+            self.btn_confirm_columns.setVisible(False)
+            return
 
-        # Set gene column as category
-        self.df.gene = self.df.gene.astype("category")
+        # Read only x y and gene, renamed to standardized names
+        self.df = read_transcripts(self.path, x=x, y=y, gene=gene)
 
         # Save gene expression to the dataset
         self.dataset.add_gene_expression(self.df)
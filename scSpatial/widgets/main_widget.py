@@ -8,6 +8,8 @@ from .loaddata import loadWidget
 from .segmentation import segmentationWidget
 from .analysis import analysisWidget
 from .visualization import visualizationWidget
+from .jobs import jobWidget
+from ..jobs import get_scheduler
 from ..dataset import Dataset
 
 
@@ -34,6 +36,7 @@ class mainWidget(QWidget):
 
         # Add all widgets in order
         layout.addWidget(self.tabs)
+        layout.addWidget(jobWidget(get_scheduler()))
 
         # Set layout on mainWidget
         self.setLayout(layout)
@@ -1,5 +1,4 @@
 import plotly.express as px
-import pandas as pd
 import numpy as np
 import imageio
 from PyQt5.QtCore import Qt
@@ -25,6 +24,8 @@ import napari
 import sys
 
 from ..dataset import Dataset
+from ..export import export_segmentation
+from ..jobs import Job, get_scheduler
 from ..segmentation import Segmentation, segmentCytoplasm, segmentNuclei
 from ..viewer import Viewer
 from ..analysis import Bonefight
@@ -151,59 +152,61 @@ class segmentationCreateWidget(QWidget):
         path = QFileDialog.getOpenFileName(self, caption="select a segmentation file")[
             0
         ]
+        if not path:
+            return
 
+        job = Job("Load segmentation", self.segment_external, path)
+        job.returned.connect(self.add_segmentation)
+        get_scheduler().submit(job)
+
+    def segment_external(self, path: str) -> Segmentation:
+        """create a segmentation from a label image, runs in a job"""
         masks = imageio.imread(path).astype(int)
-        seg = Segmentation(
+        return Segmentation(
             dataset=self.dataset,
             type="External",
             objects=masks,
             settings={"name": path.split("/")[-1]}
         )
-        
-        self.viewer.add_segmentation(seg, self.dataset)
+
+    def selected_method(self):
+        """returns segmentation class and settings selected in the UI"""
+        settings = dict(
+            size=int(self.lbl_size.text()),
+            flow_threshold=float(self.lbl_flow_th.text()),
+            mask_threshold=float(self.lbl_mask_th.text()),
+        )
+
+        if self.method_combo.currentText() == "Cellpose - Nuclei":
+            return segmentNuclei, settings
+        if self.method_combo.currentText() == "Cellpose - Cytoplasm":
+            return segmentCytoplasm, settings
 
     def run_segmentation_test(self):
         _, y, x = self.viewer.camera.center
-        crop = self.dataset.crop(center=(y, x))
+        method, settings = self.selected_method()
 
-        size = int(self.lbl_size.text())
-        f_th = float(self.lbl_flow_th.text())
-        m_th = float(self.lbl_mask_th.text())
+        job = Job("Test segmentation", self.segment_crop, method, (y, x), settings)
+        job.returned.connect(self.add_test_segmentation)
+        get_scheduler().submit(job)
 
-        if self.method_combo.currentText() == "Cellpose - Nuclei":
-            seg = segmentNuclei(
-                dataset=crop, size=size, flow_threshold=f_th, mask_threshold=m_th
-            )
-        if self.method_combo.currentText() == "Cellpose - Cytoplasm":
-            seg = segmentCytoplasm(
-                dataset=crop, size=size, flow_threshold=f_th, mask_threshold=m_th
-            )
+    def segment_crop(self, method, center: tuple, settings: dict) -> Segmentation:
+        """segment a crop around center, runs in a job"""
+        crop = self.dataset.crop(center=center)
+        return method(dataset=crop, **settings)
 
-      
-        self.viewer.add_segmentation(seg, crop)
+    def add_test_segmentation(self, seg: Segmentation):
+        self.viewer.add_segmentation(seg, seg.dataset)
         self.dataset.add_segmentation(seg)
 
-
     def run_segmentation(self):
-        size = int(self.lbl_size.text())
-        f_th = float(self.lbl_flow_th.text())
-        m_th = float(self.lbl_mask_th.text())
+        method, settings = self.selected_method()
 
-        if self.method_combo.currentText() == "Cellpose - Nuclei":
-            seg = segmentNuclei(
-                dataset=self.dataset,
-                size=size,
-                flow_threshold=f_th,
-                mask_threshold=m_th,
-            )
-        if self.method_combo.currentText() == "Cellpose - Cytoplasm":
-            seg = segmentCytoplasm(
-                dataset=self.dataset,
-                size=size,
-                flow_threshold=f_th,
-                mask_threshold=m_th,
-            )
+        job = Job("Segmentation", method, dataset=self.dataset, **settings)
+        job.returned.connect(self.add_segmentation)
+        get_scheduler().submit(job)
 
+    def add_segmentation(self, seg: Segmentation):
         self.viewer.add_segmentation(seg, self.dataset)
 
 
@@ -249,7 +252,7 @@ class segmentationControlWidget(QWidget):
         self.layout.addWidget(set_btn)
 
         export_btn = QPushButton("Export segmentation")
-        export_btn.setToolTip("Exports an excel file with information about mapped genes to objects and background")
+        export_btn.setToolTip("Exports an AnnData (.h5ad) file with gene counts, features and cell types of objects, and a Parquet file with the object of every spot")
         export_btn.clicked.connect(self.export_seg)
         self.layout.addWidget(export_btn)
 
@@ -294,16 +297,9 @@ class segmentationControlWidget(QWidget):
         id = self.seg_table.item(row, 0)
         seg = self.dataset.segmentation[int(id.text())]
 
-        path = QFileDialog.getSaveFileName(caption="Save as", filter="Excel File (*.xlsx)")[0]
-        writer = pd.ExcelWriter(path)
-        seg.gene_expression.to_excel(writer, sheet_name="Gene Expression")
-        seg.background.to_excel(writer, sheet_name="Background")
-        seg.dataset.gene_expression.to_excel(writer, sheet_name="Object Mapping")
-
-        if isinstance(seg.cell_types, pd.DataFrame):
-            seg.cell_types.to_excel(writer, sheet_name="Bonefight celltypes")
-
-        writer.save()
+        path = QFileDialog.getSaveFileName(caption="Save as", filter="AnnData (*.h5ad)")[0]
+        if path:
+            get_scheduler().submit(Job("Export segmentation", export_segmentation, seg, path))
 
     def update_segmentation_list(self):
         self.seg_table.clear()
@@ -357,7 +353,7 @@ class segmentationInfoWidget(QWidget):
         self.layout = QVBoxLayout(self)
 
         self.info_form_layout = QFormLayout()
-        sum_tot = self.seg.gene_expression.sum().sum()
+        sum_tot = self.seg.gene_expression.gene_totals().sum()
         sum_backgound = self.seg.background.sum()
         total_pct =  sum_tot / (sum_tot + sum_backgound)
         self.info_form_layout.addRow(
@@ -6,13 +6,17 @@ from PyQt5.QtWidgets import (
     QWidget,
     QSpinBox)
 
+from collections import OrderedDict
 import numpy as np
 from vispy.color.colormap import Colormap, MatplotlibColormap
 
 
 from ..dataset import Dataset
+from ..rendering import count_dtype, render_labels
 from ..viewer import Viewer
 
+MAX_RENDERED = 16 # number of rendered gene and cell type images kept
+
 
 
 class visualizationWidget(QWidget):
@@ -23,6 +27,8 @@ class visualizationWidget(QWidget):
         super().__init__()
         self.dataset = dataset
         self.viewer = viewer
+        # Rendered images keyed by what they show, see render
+        self.rendered: OrderedDict = OrderedDict()
         self.initUI()
 
     def initUI(self):
@@ -67,17 +73,13 @@ class visualizationWidget(QWidget):
 
         # set seg to active segmentation
         self.seg = self.dataset.active_segmentation
-        
-        used_genes = []
-        for gene in self.seg.gene_expression.columns:
-            # Only include genes with expression in at least one object
-            if sum(self.seg.gene_expression[gene]) > 0:
-                used_genes.append(gene)
 
-        self.seg.gene_expression = self.seg.gene_expression[used_genes]
+        # Cell types may have changed, so rendered images are outdated
+        self.rendered.clear()
 
+        # Only include genes with expression in at least one object
         self.gene_combo.clear()
-        for gene in self.seg.gene_expression.columns:
+        for gene in self.seg.gene_expression.nonzero_genes():
             self.gene_combo.addItem(gene)
 
         # If cell type information is available
@@ -91,55 +93,52 @@ class visualizationWidget(QWidget):
         # Get settings
         gene = self.gene_combo.currentText()
         th = self.gene_th_spin.value()
-        
-        # Fetch gene expression information
-        values = self.seg.gene_expression[gene].values
-        index = self.seg.gene_expression.index
-
-        # Use downsampled objects
-        objects = self.seg.downsampled[0]
-        scale = self.seg.downsampled[1]
 
-        # Create a zero canvas of same size as objects
-        image = np.zeros(shape=objects.shape)
+        key = ("gene", self.seg.id, gene, th)
+        if key not in self.rendered:
+            # Fetch gene expression information
+            counts = self.seg.gene_expression.get_gene(gene)
 
-        for idx, value in zip(index, values):
             # Only plot cells with number of gene spots above th
-            if value >= th:
-                # Where segmentation index, set corresponding value on image
-                image[objects == idx] = value
-        
-        self.viewer.add_image(
-            data=image,
-            name=f"{gene} - th:{th}",
-            blending="additive",
-            opacity=0.7,
-            scale=(scale, scale)
-        )
+            values = np.where(counts.values >= th, counts.values, 0)
+            self.render(key, counts.index, values, count_dtype(values))
+
+        self.add_rendered(key, name=f"{gene} - th:{th}")
 
     def add_cell_type(self):
         """Add cell type to viewer"""
         cell_type = self.cell_type_combo.currentText()
 
-        values = self.seg.cell_types[cell_type].values
-        index = self.seg.cell_types[cell_type].index
+        key = ("cell type", self.seg.id, cell_type)
+        if key not in self.rendered:
+            values = self.seg.cell_types[cell_type]
+            self.render(key, values.index, values.values, np.float32)
 
-        # Use downsampled objects
-        objects = self.seg.downsampled[0]
-        scale = self.seg.downsampled[1]
+        self.add_rendered(key, name=f"{cell_type}")
 
-        # Create a zero canvas of same size as objects
-        image = np.zeros(shape=objects.shape)
+    def render(self, key: tuple, index, values, dtype):
+        """Color the object pyramid, from the downsampled level and coarser,
+        by value and cache the images under key"""
+        level = int(np.log2(self.seg.downsampled[1]))
+        self.rendered[key] = [
+            render_labels(objects, index, values, dtype)
+            for objects in self.seg.pyramid[level:]
+        ]
+
+        # Drop the oldest images
+        while len(self.rendered) > MAX_RENDERED:
+            self.rendered.popitem(last=False)
+
+    def add_rendered(self, key: tuple, name: str):
+        self.rendered.move_to_end(key)
+        scale = self.seg.downsampled[1]
+        images = self.rendered[key]
+        multiscale = len(images) > 1
 
-        for idx, value in zip(index, values):
-            # Only plot cells with number of gene spots above th
-            if value > 0:
-                # Where segmentation index, set corresponding value on image
-                image[objects == idx] = value
-        
         self.viewer.add_image(
-            data=image,
-            name=f"{cell_type}",
+            data=images if multiscale else images[0],
+            multiscale=multiscale,
+            name=name,
             blending="additive",
             opacity=0.7,
             scale=(scale, scale)
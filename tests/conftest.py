@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+from skimage.measure import label
+
+from scSpatial.dataset import Dataset
+from scSpatial.segmentation import Segmentation
+
+SHAPE = (120, 90)
+GENES = ["Gad1", "Pvalb", "Slc17a7", "Sst"]
+
+
+@pytest.fixture
+def dataset(tmp_path) -> Dataset:
+    """dataset with a nuclei image file, a cytoplasm image without a file and random spots"""
+    rng = np.random.default_rng(0)
+    tifffile.imwrite(tmp_path / "nuclei.tif", rng.integers(0, 1000, SHAPE).astype(np.uint16))
+
+    dataset = Dataset("test")
+    dataset.load_nuclei(str(tmp_path / "nuclei.tif"))
+    dataset.images["Cytoplasm"] = rng.integers(0, 255, SHAPE).astype(np.uint8)
+    dataset.add_gene_expression(pd.DataFrame({
+        "x": rng.uniform(0, SHAPE[1], 2000),
+        "y": rng.uniform(0, SHAPE[0], 2000),
+        "gene": rng.choice(GENES, 2000),
+    }))
+    return dataset
+
+
+@pytest.fixture
+def segmentation(dataset) -> Segmentation:
+    """segmentation of random blobs with genes mapped and cell types"""
+    objects = label(np.random.default_rng(1).random(SHAPE) > 0.7).astype(np.int32)
+    seg = Segmentation(dataset, type="External", settings={"name": "blobs"}, objects=objects)
+    dataset.set_active_segmentation(seg)
+
+    labels = seg.object_features.label
+    cell_types = pd.DataFrame(
+        np.random.default_rng(2).random((len(labels), 2)), index=labels, columns=["neuron", "glia"]
+    )
+    seg.add_cell_types(cell_types)
+    return seg
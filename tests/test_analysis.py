@@ -0,0 +1,96 @@
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import optimize, sparse
+
+from scSpatial.analysis import ScoreTransfer, correlation_scores, group_means, nnls_scores, read_reference
+
+
+def make_reference(n_cells=500, n_genes=30, seed=0):
+    """random counts and a group of each cell, some cells without a group"""
+    rng = np.random.default_rng(seed)
+    X = rng.poisson(0.5, (n_cells, n_genes)).astype(np.float32)
+    groups = pd.Series(rng.choice(["astrocyte", "neuron", "microglia", None], n_cells))
+    return X, groups
+
+
+def expected_means(X, groups):
+    means = pd.DataFrame(X).groupby(groups.to_numpy()).mean()
+    return means, groups.value_counts().sort_index()
+
+
+@pytest.mark.parametrize("to_matrix", [np.asarray, sparse.csr_matrix, sparse.csc_matrix])
+@pytest.mark.parametrize("chunk_size", [37, 10_000])
+def test_group_means_match_groupby(to_matrix, chunk_size):
+    X, groups = make_reference()
+
+    means, sizes = group_means(to_matrix(X), groups, chunk_size=chunk_size)
+    expected, expected_sizes = expected_means(X, groups)
+
+    assert list(means.index) == list(expected.index)
+    np.testing.assert_allclose(means.to_numpy(), expected.to_numpy(), rtol=1e-6)
+    np.testing.assert_array_equal(sizes.to_numpy(), expected_sizes.to_numpy())
+
+
+def test_group_means_of_backed_reference(tmp_path):
+    X, groups = make_reference()
+    path = tmp_path / "reference.h5ad"
+    obs = pd.DataFrame({"cluster": groups.fillna("").to_numpy()}, index=np.arange(len(X)).astype(str))
+    anndata.AnnData(X=sparse.csr_matrix(X), obs=obs).write_h5ad(path)
+
+    reference = read_reference(str(path))
+    means, _ = group_means(reference.X, reference.obs.cluster, chunk_size=100)
+    expected, _ = expected_means(X, groups.fillna(""))
+
+    assert reference.isbacked
+    np.testing.assert_allclose(means.to_numpy(), expected.to_numpy(), rtol=1e-6)
+
+
+def make_counts(n_cells=50, n_genes=20, n_groups=4, seed=0):
+    """sparse counts of cells drawn from a mix of group profiles"""
+    rng = np.random.default_rng(seed)
+    reference = rng.gamma(1.0, 2.0, (n_groups, n_genes))
+    weights = rng.dirichlet(np.ones(n_groups) * 0.5, n_cells)
+    counts = sparse.csr_matrix(rng.poisson(weights @ reference * 3).astype(np.float32))
+    return counts, reference
+
+
+def test_correlation_scores_match_corrcoef():
+    counts, reference = make_counts()
+    # A cell without counts has no correlation
+    counts = sparse.csr_matrix(np.vstack([np.zeros(counts.shape[1]), counts.toarray()[1:]]))
+
+    scores = correlation_scores(counts, reference)
+
+    dense = np.log1p(counts.toarray())
+    expected = np.array([
+        [np.corrcoef(cell, np.log1p(group))[0, 1] for group in reference] for cell in dense[1:]
+    ])
+    np.testing.assert_allclose(scores[1:], expected, atol=1e-5)
+    np.testing.assert_array_equal(scores[0], 0)
+
+
+def test_nnls_scores_match_scipy_nnls():
+    counts, reference = make_counts()
+
+    scores = nnls_scores(counts, reference, n_iter=5000)
+
+    for cell, score in zip(counts.toarray(), scores):
+        weights, _ = optimize.nnls(reference.T, cell)
+        np.testing.assert_allclose(score, weights / weights.sum(), atol=1e-3)
+
+
+@pytest.mark.parametrize("method", ["correlation", "nnls"])
+def test_score_transfer(segmentation, method):
+    genes = list(segmentation.gene_expression.columns) + ["Snap25"]
+    X, groups = make_reference(n_genes=len(genes))
+    obs = pd.DataFrame({"cluster": groups.fillna("neuron").to_numpy()}, index=np.arange(len(X)).astype(str))
+    reference = anndata.AnnData(X=sparse.csr_matrix(X), obs=obs, var=pd.DataFrame(index=genes))
+
+    cell_types = ScoreTransfer(segmentation, reference, "cluster", method=method).transfer_labels()
+    blocks = ScoreTransfer(segmentation, reference, "cluster", method=method, block_size=7, n_workers=3).transfer_labels()
+
+    assert list(cell_types.index) == list(segmentation.gene_expression.index)
+    assert list(cell_types.columns) == ["astrocyte", "microglia", "neuron"]
+    pd.testing.assert_frame_equal(cell_types, blocks)
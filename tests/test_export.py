@@ -0,0 +1,30 @@
+import anndata
+import numpy as np
+import pandas as pd
+
+from scSpatial.export import export_segmentation
+from scSpatial.mapping import lookup_objects
+
+
+def test_export_segmentation(tmp_path, segmentation):
+    export_segmentation(segmentation, str(tmp_path / "sample.h5ad"))
+    adata = anndata.read_h5ad(tmp_path / "sample.h5ad")
+    spots = pd.read_parquet(tmp_path / "sample.spots.parquet")
+
+    # Every object has a row, objects without spots have zero counts
+    features = segmentation.object_features
+    assert list(adata.obs_names) == [str(label) for label in features.label]
+    assert list(adata.var_names) == list(segmentation.gene_expression.columns)
+    counts = pd.DataFrame(adata.X.toarray(), index=features.label.to_numpy())
+    expression = segmentation.gene_expression
+    np.testing.assert_array_equal(counts.loc[expression.index].to_numpy(), expression.matrix.toarray())
+    assert counts.drop(index=expression.index).to_numpy().sum() == 0
+
+    np.testing.assert_allclose(adata.obsm["spatial"], features[["centroid-1", "centroid-0"]].to_numpy())
+    np.testing.assert_allclose(adata.obsm["cell_types"].to_numpy(), segmentation.cell_types.to_numpy(), rtol=1e-6)
+    np.testing.assert_allclose(adata.var["background"], segmentation.background.to_numpy())
+    assert adata.uns["segmentation"]["type"] == "External"
+
+    genes = segmentation.dataset.gene_expression
+    np.testing.assert_array_equal(spots.object_id, lookup_objects(segmentation.objects, genes.x, genes.y))
+    np.testing.assert_array_equal(spots.gene, genes.gene)
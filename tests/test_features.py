@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from skimage.measure import label, regionprops_table
+
+from scSpatial.features import object_features
+
+COLUMNS = ["label", "centroid-0", "centroid-1", "area", "equivalent_diameter_area",
+           "bbox-0", "bbox-1", "bbox-2", "bbox-3"]
+
+
+def make_objects(shape=(200, 150), seed=0) -> np.ndarray:
+    """label image of random blobs, some of them touching chunk borders"""
+    rng = np.random.default_rng(seed)
+    return label(rng.random(shape) > 0.6)
+
+
+@pytest.mark.parametrize("chunk_pixels, n_workers", [(10**6, 1), (1000, 1), (1000, 4), (1, 2)])
+def test_object_features_match_regionprops(chunk_pixels, n_workers):
+    labels = make_objects()
+
+    features, coverage = object_features(labels, chunk_pixels=chunk_pixels, n_workers=n_workers)
+    expected = pd.DataFrame(regionprops_table(
+        labels, properties=["label", "centroid", "area", "equivalent_diameter_area", "bbox"]
+    ))
+
+    for column in COLUMNS:
+        np.testing.assert_allclose(features[column], expected[column], err_msg=column)
+    assert coverage == pytest.approx((labels > 0).mean())
+
+
+def test_objects_split_along_rows():
+    labels = np.zeros((6, 8), dtype=np.int32)
+    labels[1, 1:3] = 4
+    labels[1, 5:7] = 4 # second run of the same object on the same row
+    labels[2:5, 2:7] = 4
+    labels[2, 0:2] = 9 # touches object 4
+
+    features, _ = object_features(labels)
+    expected = pd.DataFrame(regionprops_table(labels, properties=["label", "centroid", "area", "bbox"]))
+
+    for column in expected:
+        np.testing.assert_allclose(features[column], expected[column], err_msg=column)
+
+
+def test_object_features_skip_missing_labels():
+    labels = np.zeros((20, 20), dtype=np.int32)
+    labels[2:5, 2:5] = 3
+    labels[10:12, 10:15] = 7
+
+    features, coverage = object_features(labels)
+
+    assert features.label.tolist() == [3, 7]
+    assert features.area.tolist() == [9, 10]
+    assert coverage == pytest.approx(19 / 400)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.float32])
+def test_intensity_features_match_regionprops(dtype):
+    labels = make_objects()
+    intensity = (np.random.default_rng(1).random(labels.shape) * 200).astype(dtype)
+
+    features, _ = object_features(labels, images={"Nuclei": intensity}, chunk_pixels=1000, n_workers=2)
+    expected = pd.DataFrame(regionprops_table(
+        labels, intensity_image=intensity, properties=["label", "area", "intensity_mean", "intensity_max"]
+    ))
+
+    np.testing.assert_allclose(features["Nuclei_mean"], expected["intensity_mean"], rtol=1e-6)
+    np.testing.assert_allclose(features["Nuclei_max"], expected["intensity_max"])
+    np.testing.assert_allclose(features["Nuclei_integrated"], expected["intensity_mean"] * expected["area"], rtol=1e-6)
+
+
+def test_intensity_features_skip_images_of_other_shape():
+    labels = make_objects((30, 30))
+    features, _ = object_features(labels, images={"Nuclei": np.ones((10, 10))})
+
+    assert "Nuclei_mean" not in features
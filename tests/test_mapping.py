@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+from scSpatial.mapping import lookup_objects, map_spots, map_spots_streaming
+from scSpatial.segmentation import Segmentation
+from scSpatial.transcripts import TranscriptFile
+
+
+def make_data(n_spots=1000, shape=(60, 80), seed=0):
+    """random label image and spots inside of it"""
+    rng = np.random.default_rng(seed)
+    objects = rng.integers(0, 12, shape)
+    spots = pd.DataFrame({
+        "x": rng.uniform(0, shape[1], n_spots),
+        "y": rng.uniform(0, shape[0], n_spots),
+        "gene": rng.choice(["Gad1", "Slc17a7", "Pvalb", "Sst"], n_spots),
+    })
+    return objects, spots
+
+
+def test_map_spots_matches_per_spot_loop():
+    objects, spots = make_data()
+
+    object_ids, counts, genes = map_spots(objects, spots, batch_size=97)
+
+    expected_ids = list()
+    expected_counts = np.zeros(counts.shape, dtype=int)
+    for _, spot in spots.iterrows():
+        object_id = objects[int(spot.y), int(spot.x)]
+        expected_ids.append(object_id)
+        expected_counts[object_id, genes.get_loc(spot.gene)] += 1
+
+    np.testing.assert_array_equal(object_ids, expected_ids)
+    np.testing.assert_array_equal(counts.toarray(), expected_counts)
+    assert list(genes) == sorted(spots.gene.unique())
+
+
+def test_map_spots_outside_image_are_background():
+    objects = np.ones((10, 10), dtype=np.int32)
+    spots = pd.DataFrame({
+        "x": [-3.0, 5.0, 12.0, 5.0],
+        "y": [5.0, -1.5, 5.0, 10.0],
+        "gene": ["a", "a", "b", "b"],
+    })
+
+    object_ids, counts, _ = map_spots(objects, spots)
+
+    np.testing.assert_array_equal(object_ids, 0)
+    assert counts[0].sum() == 4
+
+
+def test_streaming_matches_map_spots(tmp_path):
+    objects, spots = make_data()
+    # Genes first seen in later chunks add columns
+    spots.loc[:499, "gene"] = "Gad1"
+    chunks = (spots.iloc[start:start + 300] for start in range(0, len(spots), 300))
+    output = str(tmp_path / "spots.parquet")
+
+    counts, genes = map_spots_streaming(objects, chunks, output_path=output)
+    expected_ids, expected_counts, expected_genes = map_spots(objects, spots)
+
+    assert list(genes) == list(expected_genes)
+    np.testing.assert_array_equal(counts.toarray(), expected_counts.toarray())
+
+    written = pd.read_parquet(output)
+    np.testing.assert_array_equal(written.object_id, expected_ids)
+    np.testing.assert_array_equal(written.gene, spots.gene)
+
+
+def test_streaming_transcript_file(tmp_path):
+    objects, spots = make_data()
+    path = str(tmp_path / "spots.csv")
+    spots.rename(columns={"x": "PosX", "y": "PosY", "gene": "Gene"}).to_csv(path, index=False)
+    transcripts = TranscriptFile(path, x="PosX", y="PosY", gene="Gene", chunk_size=128)
+
+    counts, genes = map_spots_streaming(objects, transcripts.chunks())
+    _, expected_counts, expected_genes = map_spots(objects, spots)
+
+    assert list(genes) == list(expected_genes)
+    np.testing.assert_array_equal(counts.toarray(), expected_counts.toarray())
+
+
+def test_segmentation_streams_transcript_file(tmp_path, dataset, segmentation):
+    path = str(tmp_path / "spots.parquet")
+    spots = dataset.gene_expression[["x", "y", "gene"]]
+    spots.to_parquet(path)
+    dataset.add_transcript_file(TranscriptFile(path, x="x", y="y", gene="gene", chunk_size=500))
+
+    streamed = Segmentation(dataset, type="External", settings={}, objects=segmentation.objects)
+
+    assert (streamed.gene_expression.matrix != segmentation.gene_expression.matrix).nnz == 0
+    assert list(streamed.gene_expression.index) == list(segmentation.gene_expression.index)
+    pd.testing.assert_series_equal(streamed.background, segmentation.background)
+    written = pd.read_parquet(streamed.object_mapping_path)
+    np.testing.assert_array_equal(written.object_id, lookup_objects(segmentation.objects, spots.x, spots.y))
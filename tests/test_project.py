@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from scSpatial.dataset import Dataset
+from scSpatial.project import load_project, save_project
+
+
+def test_save_and_load_project(tmp_path, dataset, segmentation):
+    path = str(tmp_path / "project.zarr")
+    save_project(dataset, path)
+
+    loaded = load_project(path, Dataset("empty"))
+
+    assert loaded.name == "test"
+    assert Dataset.all["test"] is loaded and "empty" not in Dataset.all
+
+    # Images with a file are referenced, others are stored in the project
+    assert loaded.image_paths == dataset.image_paths
+    for channel, image in dataset.images.items():
+        np.testing.assert_array_equal(np.asarray(loaded.images[channel]), np.asarray(image))
+
+    pd.testing.assert_frame_equal(loaded.gene_expression, dataset.gene_expression)
+
+    seg = loaded.segmentation[segmentation.id]
+    assert loaded.active_segmentation is seg
+    assert seg.type == segmentation.type and seg.settings == segmentation.settings
+    np.testing.assert_array_equal(np.asarray(seg.objects), segmentation.objects)
+    assert len(seg.pyramid) == len(segmentation.pyramid)
+    pd.testing.assert_frame_equal(seg.object_features, segmentation.object_features)
+    assert seg.object_coverage == segmentation.object_coverage
+    pd.testing.assert_frame_equal(seg.cell_types, segmentation.cell_types)
+
+    assert (seg.gene_expression.matrix != segmentation.gene_expression.matrix).nnz == 0
+    assert list(seg.gene_expression.index) == list(segmentation.gene_expression.index)
+    assert list(seg.gene_expression.columns) == list(segmentation.gene_expression.columns)
+    pd.testing.assert_series_equal(seg.background, segmentation.background, check_names=False)
+
+
+def test_save_project_over_itself(tmp_path, dataset, segmentation):
+    path = str(tmp_path / "project.zarr")
+    save_project(dataset, path)
+    loaded = load_project(path, Dataset("first"))
+
+    save_project(loaded, path)
+    reloaded = load_project(path, Dataset("second"))
+
+    np.testing.assert_array_equal(
+        np.asarray(reloaded.segmentation[segmentation.id].objects), segmentation.objects
+    )
+
+
+def test_cropped_images_are_stored_in_the_project(tmp_path, dataset):
+    cropped = dataset.crop((60, 45), width=40, height=30)
+    path = str(tmp_path / "project.zarr")
+    save_project(cropped, path)
+
+    loaded = load_project(path, Dataset("empty"))
+
+    assert loaded.image_paths == {}
+    assert loaded.translate == cropped.translate
+    np.testing.assert_array_equal(np.asarray(loaded.images["Nuclei"]), np.asarray(cropped.images["Nuclei"]))
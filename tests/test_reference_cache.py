@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import pandas as pd
+
+from scSpatial.reference_cache import ReferenceCache, reference_key
+
+
+def test_reference_key_depends_on_file_and_groupby(tmp_path):
+    path = tmp_path / "reference.h5ad"
+    path.write_bytes(b"reference")
+    key = reference_key(str(path), "cluster")
+
+    assert key == reference_key(str(path), "cluster")
+    assert key != reference_key(str(path), "class")
+
+    os.utime(path, (0, 0))
+    assert key != reference_key(str(path), "cluster")
+
+
+def test_put_and_get(tmp_path):
+    cache = ReferenceCache(str(tmp_path / "references"))
+    groups = pd.Index(["astrocyte", "neuron"], name="cluster")
+    means = pd.DataFrame(np.random.default_rng(0).random((3, 2)), index=["Gad1", "Pvalb", "Sst"], columns=groups)
+    sizes = pd.Series([10, 20], index=groups)
+
+    assert cache.get("key") is None
+    cache.put("key", means, sizes)
+    cached_means, cached_sizes = cache.get("key")
+
+    pd.testing.assert_frame_equal(cached_means, means, check_index_type=False)
+    assert cached_means.columns.name == "cluster"
+    pd.testing.assert_series_equal(cached_sizes, sizes, check_index_type=False)
+
+    cache.clear()
+    assert cache.get("key") is None
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pandas as pd
+import zarr
+
+from scSpatial.result_cache import ResultCache, hash_image, result_key
+
+
+def make_result(seed=0, shape=(40, 30)):
+    rng = np.random.default_rng(seed)
+    objects = rng.integers(0, 5, shape).astype(np.int32)
+    features = pd.DataFrame({"label": [1, 2, 3, 4], "area": rng.random(4)})
+    return objects, features
+
+
+def test_hash_image_depends_on_pixels_only():
+    image = np.random.default_rng(0).integers(0, 255, (3000, 20)).astype(np.uint8)
+    lazy = zarr.array(image, chunks=(100, 20))
+
+    assert hash_image(image) == hash_image(lazy)
+    assert hash_image(image) != hash_image(image.astype(np.uint16))
+
+    changed = image.copy()
+    changed[-1, -1] += 1
+    assert hash_image(image) != hash_image(changed)
+
+
+def test_result_key_depends_on_settings_and_images():
+    key = result_key("Nuclei", dict(size=30), ["a"], tile_size=2048)
+
+    assert key == result_key("Nuclei", dict(size=30), ["a"], tile_size=2048)
+    assert key != result_key("Nuclei", dict(size=31), ["a"], tile_size=2048)
+    assert key != result_key("Nuclei", dict(size=30), ["b"], tile_size=2048)
+    assert key != result_key("Nuclei", dict(size=30), ["a"], tile_size=1024)
+
+
+def test_put_and_get(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    objects, features = make_result()
+
+    assert cache.get("key") is None
+    cache.put("key", objects, features, object_coverage=0.5, feature_images={"Nuclei": "digest"})
+    result = cache.get("key")
+
+    np.testing.assert_array_equal(result["objects"], objects)
+    pd.testing.assert_frame_equal(result["object_features"], features)
+    assert result["object_coverage"] == 0.5
+    assert result["feature_images"] == {"Nuclei": "digest"}
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entries_are_dropped(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, *make_result(seed=i))
+        os.utime(os.path.join(cache.entry_path(key), "meta.json"), (i, i))
+    entry_size = cache.nbytes // 3
+
+    # Reading "a" makes "b" the least recently used
+    cache.get("a")
+    cache.max_bytes = 3 * entry_size + entry_size // 2
+    cache.put("d", *make_result(seed=3))
+
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in ["a", "c", "d"])
+
+
+def test_results_larger_than_the_cache_are_not_stored(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10)
+    cache.put("key", *make_result())
+
+    assert cache.get("key") is None
+    assert cache.entries() == []
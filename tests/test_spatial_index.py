@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from scSpatial.spatial_index import SpatialIndex
+
+
+@pytest.fixture
+def spots():
+    rng = np.random.default_rng(0)
+    return rng.uniform(-20, 1000, 5000), rng.uniform(0, 700, 5000)
+
+
+def brute_force(row, col, row0, row1, col0, col1) -> np.ndarray:
+    return np.flatnonzero((row >= row0) & (row < row1) & (col >= col0) & (col < col1))
+
+
+def test_query_matches_brute_force(spots):
+    row, col = spots
+    index = SpatialIndex(row, col, tile_size=64)
+    rng = np.random.default_rng(1)
+
+    for _ in range(200):
+        row0, row1 = np.sort(rng.uniform(-100, 1100, 2))
+        col0, col1 = np.sort(rng.uniform(-100, 800, 2))
+        np.testing.assert_array_equal(
+            index.query(row0, row1, col0, col1),
+            brute_force(row, col, row0, row1, col0, col1)
+        )
+
+
+@pytest.mark.parametrize("box", [
+    (0, 1000, 0, 700), # everything inside of the image
+    (-50, 0, 0, 700), # spots left of the first tile
+    (2000, 3000, 0, 700), # beyond the last tile
+    (100, 100, 0, 700), # empty box
+    (300, 200, 0, 700), # inverted box
+])
+def test_query_edge_boxes(spots, box):
+    row, col = spots
+    index = SpatialIndex(row, col, tile_size=64)
+
+    np.testing.assert_array_equal(index.query(*box), brute_force(row, col, *box))
+
+
+def test_empty_index():
+    index = SpatialIndex(np.array([]), np.array([]))
+
+    assert len(index) == 0
+    assert len(index.query(0, 10, 0, 10)) == 0
@@ -0,0 +1,60 @@
+import numpy as np
+from skimage.measure import label
+
+from scSpatial.tiling import stitch_tiles, tile_grid
+
+CELL_SIZE = 16 # every object lies in its own cell, separated by at least one pixel
+
+
+def make_objects(shape=(300, 250), max_size=8, seed=0) -> np.ndarray:
+    """binary image of separate squares of random size and position"""
+    rng = np.random.default_rng(seed)
+    image = np.zeros(shape, dtype=bool)
+    for r in range(0, shape[0] - CELL_SIZE, CELL_SIZE):
+        for c in range(0, shape[1] - CELL_SIZE, CELL_SIZE):
+            if rng.random() < 0.2:
+                continue
+            size = rng.integers(1, max_size + 1)
+            dr, dc = rng.integers(0, CELL_SIZE - size, 2)
+            image[r + dr:r + dr + size, c + dc:c + dc + size] = True
+    return image
+
+
+def same_objects(a: np.ndarray, b: np.ndarray) -> bool:
+    """True if two label images hold the same objects, labelled differently"""
+    if not np.array_equal(a > 0, b > 0):
+        return False
+    pairs = np.unique(np.stack([a[a > 0], b[b > 0]]), axis=1)
+    return pairs.shape[1] == len(np.unique(a[a > 0])) == len(np.unique(b[b > 0]))
+
+
+def test_stitch_tiles_matches_whole_image_labelling():
+    image = make_objects()
+    tiles = tile_grid(image.shape, tile_size=64, overlap=20)
+    masks = [label(image[r0:r1, c0:c1]) for r0, r1, c0, c1 in tiles]
+
+    stitched = stitch_tiles(image.shape, tiles, masks)
+
+    assert len(tiles) > 1
+    assert same_objects(stitched, label(image))
+    np.testing.assert_array_equal(np.unique(stitched), np.arange(stitched.max() + 1))
+
+
+def test_single_tile_keeps_labels():
+    image = make_objects((50, 40))
+    tiles = tile_grid(image.shape, tile_size=64, overlap=20)
+
+    stitched = stitch_tiles(image.shape, tiles, [label(image)])
+
+    assert tiles == [(0, 50, 0, 40)]
+    np.testing.assert_array_equal(stitched, label(image))
+
+
+def test_tile_grid_covers_image():
+    shape = (300, 250)
+    covered = np.zeros(shape, dtype=int)
+    for r0, r1, c0, c1 in tile_grid(shape, tile_size=64, overlap=20):
+        assert r1 - r0 <= 64 and c1 - c0 <= 64
+        covered[r0:r1, c0:c1] += 1
+
+    assert covered.min() >= 1